@@ -0,0 +1,4 @@
+"""Benchmarks for the extractor on synthetic EMIS XML and a synthetic SNOMED database.
+
+Run with: python -m benchmarks.run_benchmarks --scales small,medium
+"""
@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import statistics
+import tempfile
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.synthetic_data import SyntheticTerminology, write_emis_xml
+from benchmarks.run_benchmarks import SCALES
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def request_json(url, body=None, content_type='application/json'):
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': content_type} if body is not None else {})
+    with urllib.request.urlopen(request, timeout=600) as response:
+        return json.load(response)
+
+def wait_for_service(base_url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The service exited with code {process.returncode}")
+        try:
+            return request_json(f"{base_url}/health")
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('The service did not start in time')
+
+def run_job(base_url, payload, result_format, poll_interval):
+    """Submit one payload, wait for it to finish and fetch its results; return (seconds, reports, rows, status)."""
+    start_time = time.perf_counter()
+    job = request_json(f"{base_url}/jobs", payload, 'application/xml')
+    if result_format == 'csv':
+        # CSV results are streamed while the job runs
+        with urllib.request.urlopen(f"{base_url}/jobs/{job['job']}/results?format=csv", timeout=600) as response:
+            rows = sum(1 for _ in response) - 1
+        status = request_json(f"{base_url}/jobs/{job['job']}")
+    else:
+        while (status := request_json(f"{base_url}/jobs/{job['job']}"))['status'] in ('queued', 'running'):
+            time.sleep(poll_interval)
+        results = request_json(f"{base_url}/jobs/{job['job']}/results")
+        rows = sum(len(value_set['codes']) for report in results['results'] for value_set in report['value_sets'])
+    return time.perf_counter() - start_time, status['reports'], rows, status
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure http_service.py throughput under concurrent submissions against a synthetic terminology')
+    parser.add_argument('--scale', default='small', choices=list(SCALES), help='Terminology size and report shape, as in run_benchmarks.py')
+    parser.add_argument('--payloads', type=int, default=8, help='Distinct XML payloads to generate')
+    parser.add_argument('--reports', type=int, default=5, help='Reports per payload')
+    parser.add_argument('--jobs', type=int, default=40, help='Jobs submitted in total')
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent clients')
+    parser.add_argument('--workers', type=int, default=2, help='Service worker processes')
+    parser.add_argument('--format', default='json', choices=['json', 'csv'], help='Result format fetched by the clients')
+    parser.add_argument('--snapshot', action='store_true', help='Serve from a compiled snapshot instead of the SQLite database')
+    parser.add_argument('--output', default='load_test_results.json')
+    parser.add_argument('--work_dir', default=None, help='Directory for the generated data (default: a temporary directory)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='emis_load_test_')
+    settings = SCALES[args.scale]
+    terminology = SyntheticTerminology(seed=args.seed, **settings['terminology'])
+    database_path = terminology.build_database(os.path.join(work_dir, 'terminology'))
+    xml_settings = {name: value for name, value in settings['xml'].items() if name not in ('files', 'reports')}
+    payloads = []
+    for position in range(args.payloads):
+        path = write_emis_xml(os.path.join(work_dir, 'xml', f"payload_{position}.xml"), terminology, reports=args.reports, seed=args.seed + position, **xml_settings)
+        with open(path, 'rb') as f:
+            payloads.append(f.read())
+
+    if args.snapshot:
+        from terminology_snapshot import compile_snapshot
+        terminology_args = ['--snapshot', compile_snapshot(os.path.join(work_dir, 'terminology.snap'), database_path, database_path, database_path)]
+    else:
+        terminology_args = ['--database_path', database_path, '--transitive_closure_db_path', database_path, '--history_db_path', database_path,
+                            '--cache_dir', os.path.join(work_dir, 'cache')]
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen([sys.executable, 'http_service.py', '--port', str(port), '--workers', str(args.workers), '--log_level', 'WARNING'] + terminology_args,
+                               cwd=REPO_DIR)
+    try:
+        wait_for_service(base_url, process)
+        # One job per worker first, so every worker has opened its terminology before timing starts
+        with ThreadPoolExecutor(args.workers) as warm_up:
+            list(warm_up.map(lambda position: run_job(base_url, payloads[position % len(payloads)], 'json', 0.01), range(args.workers)))
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(args.clients) as clients:
+            runs = list(clients.map(lambda position: run_job(base_url, payloads[position % len(payloads)], args.format, 0.01), range(args.jobs)))
+        elapsed = time.perf_counter() - start_time
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = [seconds for seconds, _, _, _ in runs]
+    reports = sum(report_count for _, report_count, _, _ in runs)
+    results = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'seconds': elapsed,
+        'jobs_per_second': args.jobs / elapsed,
+        'reports_per_second': reports / elapsed,
+        'rows': sum(rows for _, _, rows, _ in runs),
+        'failed_jobs': sum(1 for _, _, _, status in runs if status['status'] != 'done'),
+        'latency_seconds': {'mean': statistics.mean(latencies), 'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95), 'max': max(latencies)},
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"{args.jobs} jobs ({reports} reports) from {args.clients} clients on {args.workers} workers in {elapsed:.2f}s: "
+          f"{results['jobs_per_second']:.1f} jobs/s, {results['reports_per_second']:.1f} reports/s, "
+          f"p50 {results['latency_seconds']['p50']:.3f}s, p95 {results['latency_seconds']['p95']:.3f}s, {results['failed_jobs']} failed")
+    print(f"Results saved to {args.output}")
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import subprocess
+import statistics
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.synthetic_data import SyntheticTerminology, write_emis_xml
+
+# Terminology and XML sizes for each named scale
+SCALES = {
+    'small': {
+        'terminology': {'concepts': 5000, 'depth': 8, 'fan_out': 5},
+        'xml': {'files': 1, 'reports': 10, 'value_sets': 4, 'codes': 20, 'exceptions': 2},
+    },
+    'medium': {
+        'terminology': {'concepts': 50000, 'depth': 10, 'fan_out': 5},
+        'xml': {'files': 2, 'reports': 20, 'value_sets': 8, 'codes': 40, 'exceptions': 3},
+    },
+    'large': {
+        'terminology': {'concepts': 200000, 'depth': 12, 'fan_out': 4},
+        'xml': {'files': 4, 'reports': 40, 'value_sets': 10, 'codes': 80, 'exceptions': 5},
+    },
+}
+
+def terminology_settings(database_path):
+    return {'database_path': database_path, 'transitive_closure_db_path': database_path, 'history_db_path': database_path, 'no_result_cache': True}
+
+def load_extractor(xml_directory, database_path, output_dir):
+    """Import the extractor and configure it for the synthetic database."""
+    import emis_xml_snomed_extractor as extractor
+    extractor.configure(extractor.make_options(xml_directory, output_dir, **terminology_settings(database_path)))
+    # Log lines would dominate the timings
+    logging.getLogger("main_logger").setLevel(logging.WARNING)
+    return extractor
+
+def run_python(*args):
+    subprocess.run([sys.executable, *args], cwd=REPO_DIR, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def time_startup(extractor, xml_directory, database_path, output_dir, repeat):
+    """Time a cold start (fresh interpreter import, full command-line run) against in-process runs, first and warm."""
+    timings = {}
+    timings['cold_import'], _ = time_stage(lambda: run_python('-c', 'import emis_xml_snomed_extractor'), repeat)
+    timings['cli_run'], _ = time_stage(lambda: run_python('emis_xml_snomed_extractor.py', '--xml_directory', xml_directory, '--output_dir', output_dir,
+                                                          '--database_path', database_path, '--transitive_closure_db_path', database_path,
+                                                          '--history_db_path', database_path, '--no_result_cache', '--log_level', 'WARNING'), repeat)
+
+    def first_run():
+        pipeline = extractor.ExtractionPipeline(**terminology_settings(database_path))
+        pipeline.run(xml_directory, output_dir)
+        pipeline.close()
+    timings['pipeline_first_run'], _ = time_stage(first_run, repeat)
+    pipeline = extractor.ExtractionPipeline(**terminology_settings(database_path))
+    pipeline.run(xml_directory, output_dir)
+    timings['pipeline_warm_run'], _ = time_stage(lambda: pipeline.run(xml_directory, output_dir), repeat)
+    pipeline.close()
+    return timings
+
+def time_stage(function, repeat):
+    runs = []
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - start_time)
+    return {'best_seconds': min(runs), 'mean_seconds': statistics.mean(runs), 'runs': runs}, result
+
+def benchmark_scale(name, settings, work_dir, repeat, seed):
+    """Generate the data for one scale, time each pipeline stage on it and return the results."""
+    scale_dir = os.path.join(work_dir, name)
+    shutil.rmtree(scale_dir, ignore_errors=True)
+    xml_settings = dict(settings['xml'])
+    file_count = xml_settings.pop('files')
+
+    start_time = time.perf_counter()
+    terminology = SyntheticTerminology(seed=seed, **settings['terminology'])
+    database_path = terminology.build_database(os.path.join(scale_dir, 'terminology'))
+    xml_directory = os.path.join(scale_dir, 'xml')
+    xml_paths = [write_emis_xml(os.path.join(xml_directory, f"export_{position}.xml"), terminology, seed=seed + position, **xml_settings)
+                 for position in range(file_count)]
+    generation_seconds = time.perf_counter() - start_time
+
+    workbook_dir = os.path.join(scale_dir, 'workbooks')
+    os.makedirs(workbook_dir, exist_ok=True)
+    extractor = load_extractor(xml_directory, database_path, workbook_dir)
+    from history_resolver import HistoryMap
+    from closure_engine import ClosureIndex
+    from consolidate_workbooks import consolidate_workbooks
+    logging.getLogger('consolidate_workbooks').setLevel(logging.WARNING)
+
+    connection_main, connection_tc, connection_history = (extractor.connect_terminology(database_path) for _ in range(3))
+    timings = {}
+
+    timings['xml_parse'], trees = time_stage(lambda: [extractor.XML_PARSER.parse(path) for path in xml_paths], repeat)
+    reports = [report for tree in trees for report in tree.getroot().findall('.//ns:report', extractor.NAMESPACE)]
+    timings['extract_values_from_xml_element'], report_data = time_stage(
+        lambda: [extractor.extract_values_from_xml_element(report) for report in reports], repeat)
+    timings['extract_values_single_pass'], _ = time_stage(lambda: [extractor.extract_values_single_pass(report) for report in reports], repeat)
+
+    entries = [entry for data in report_data for value_set_data in data for entry in value_set_data]
+    timings['get_cui_from_access'], (tui_to_cui_map, display_name_to_cui_map) = time_stage(
+        lambda: extractor.get_cui_from_access([entry[0] for entry in entries], list(dict.fromkeys(entry[1] for entry in entries)), connection_main), repeat)
+    final_ids = list(dict.fromkeys(extractor.fetch_cui_values(tui_to_cui_map, display_name_to_cui_map, entry[0], entry[1])[2] for entry in entries))
+    timings['history_map_build'], history_map = time_stage(lambda: HistoryMap.from_connection(connection_history), repeat)
+    timings['get_new_cui_from_history'], new_cui_map = time_stage(lambda: extractor.get_new_cui_from_history(final_ids, history_map), repeat)
+
+    value_set_ids = (tui_to_cui_map, display_name_to_cui_map, new_cui_map)
+    children_requests = [request for data in report_data for request in extractor.collect_children_requests(data, [value_set_ids] * len(data))]
+    timings['get_all_children_from_database'], _ = time_stage(
+        lambda: [extractor.get_all_children_from_database(code, connection_tc, set(exceptions)) for code, exceptions in dict.fromkeys(children_requests)], repeat)
+    timings['get_all_children_batch'], resolved_children = time_stage(lambda: extractor.get_all_children_batch(children_requests, connection_tc), repeat)
+    timings['closure_index_load'], closure_index = time_stage(lambda: ClosureIndex.from_connection(connection_tc), repeat)
+    timings['get_all_children_batch_memory'], _ = time_stage(lambda: extractor.get_all_children_batch(children_requests, closure_index), repeat)
+
+    all_codes = set(final_ids) | {code for children in resolved_children.values() for code in children}
+    all_codes.discard("Not Found")
+    timings['fetch_all_terms'], _ = time_stage(lambda: extractor.fetch_all_terms(all_codes, connection_main), repeat)
+
+    def save_all():
+        for position, data in enumerate(report_data):
+            extractor.save_to_xlsx(data, os.path.join(workbook_dir, f"snomed_codes_BENCH{position:04d}.xlsx"),
+                                   connection_main, connection_tc, history_map)
+    timings['save_to_xlsx'], _ = time_stage(save_all, repeat)
+    consolidated_dir = os.path.join(scale_dir, 'consolidated')
+    timings['consolidate_workbooks'], _ = time_stage(lambda: consolidate_workbooks(workbook_dir, consolidated_dir), repeat)
+
+    for connection in (connection_main, connection_tc, connection_history):
+        connection.close()
+    timings.update(time_startup(extractor, xml_directory, database_path, os.path.join(scale_dir, 'runs'), repeat))
+
+    return {
+        'parameters': settings,
+        'data': {
+            'concepts': len(terminology.concept_ids),
+            'inactive_concepts': len(terminology.old_concept_ids),
+            'closure_pairs': terminology.closure_pair_count(),
+            'history_rows': len(terminology.history),
+            'xml_files': file_count,
+            'reports': len(reports),
+            'value_sets': sum(len(data) for data in report_data),
+            'codes': len(entries),
+            'children_requests': len(children_requests),
+            'generation_seconds': generation_seconds,
+        },
+        'timings': timings,
+    }
+
+def compare_results(results, baseline):
+    """Print the best time of each stage against the same stage in a baseline results file."""
+    for scale, scale_results in results['scales'].items():
+        baseline_timings = baseline.get('scales', {}).get(scale, {}).get('timings', {})
+        for stage, timing in scale_results['timings'].items():
+            if stage in baseline_timings:
+                previous = baseline_timings[stage]['best_seconds']
+                change = previous / timing['best_seconds'] if timing['best_seconds'] else float('inf')
+                print(f"{scale:8} {stage:34} {previous:9.4f}s -> {timing['best_seconds']:9.4f}s  ({change:.2f}x)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the extractor stages on synthetic EMIS XML and a synthetic SNOMED database')
+    parser.add_argument('--scales', default='small,medium', help=f"Comma-separated scales to run: {', '.join(SCALES)}")
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage; the best and mean are reported')
+    parser.add_argument('--output', default='benchmark_results.json', help='Path of the JSON results file')
+    parser.add_argument('--work_dir', default=None, help='Directory for the generated data (default: a temporary directory)')
+    parser.add_argument('--baseline', default=None, help='Earlier results file to compare against')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    scales = [scale.strip() for scale in args.scales.split(',') if scale.strip()]
+    if unknown_scales := set(scales) - set(SCALES):
+        parser.error(f"Unknown scale(s): {', '.join(sorted(unknown_scales))}")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='emis_benchmark_')
+    results = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'scales': {},
+    }
+    for scale in scales:
+        print(f"Running {scale} benchmark...")
+        results['scales'][scale] = benchmark_scale(scale, SCALES[scale], work_dir, args.repeat, args.seed)
+        for stage, timing in results['scales'][scale]['timings'].items():
+            print(f"  {stage:34} {timing['best_seconds']:9.4f}s")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            compare_results(results, json.load(f))
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
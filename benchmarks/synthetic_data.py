@@ -0,0 +1,133 @@
+import os
+import random
+from xml.sax.saxutils import escape
+from terminology_backends import build_sqlite_database
+
+EMIS_NAMESPACE = 'http://www.e-mis.com/emisopen'
+FIRST_CONCEPT_ID = 100000000
+FIRST_OLD_CONCEPT_ID = 900000000
+
+def description_id(concept_id, synonym=False):
+    return f"{concept_id}{'012' if synonym else '011'}"
+
+def preferred_term(concept_id):
+    return f"Synthetic concept {concept_id}"
+
+class SyntheticTerminology:
+    """A generated SNOMED stand-in: a multi-parent hierarchy, its transitive closure and a history table.
+
+    Concepts are added level by level below a single root, each level up to `fan_out`
+    times larger than the one above, until `concepts` exist or `depth` levels are
+    filled. A `multi_parent_ratio` share of concepts gets a second parent from the
+    level above. A `history_ratio` share of concepts gets inactive predecessors,
+    including two-hop chains, splits and retirements without a replacement.
+    """
+
+    def __init__(self, concepts=5000, depth=10, fan_out=4, multi_parent_ratio=0.2, history_ratio=0.02, seed=1):
+        rng = random.Random(seed)
+        self.concept_ids = [FIRST_CONCEPT_ID]
+        self.parents = {FIRST_CONCEPT_ID: []}
+        level = [FIRST_CONCEPT_ID]
+        for _ in range(depth - 1):
+            if len(self.concept_ids) >= concepts:
+                break
+            level_size = min(len(level) * fan_out, concepts - len(self.concept_ids))
+            next_level = []
+            for _ in range(level_size):
+                concept_id = FIRST_CONCEPT_ID + len(self.concept_ids)
+                parents = {rng.choice(level)}
+                if len(level) > 1 and rng.random() < multi_parent_ratio:
+                    parents.add(rng.choice(level))
+                self.parents[concept_id] = sorted(parents)
+                self.concept_ids.append(concept_id)
+                next_level.append(concept_id)
+            level = next_level
+
+        self.ancestors = {}
+        for concept_id in self.concept_ids:
+            ancestors = set()
+            for parent in self.parents[concept_id]:
+                ancestors.add(parent)
+                ancestors |= self.ancestors[parent]
+            self.ancestors[concept_id] = ancestors
+        self.descendants = {concept_id: [] for concept_id in self.concept_ids}
+        for concept_id, ancestors in self.ancestors.items():
+            for ancestor in ancestors:
+                self.descendants[ancestor].append(concept_id)
+
+        # Inactive concepts: a chain old -> older, a split, or a retirement
+        self.history = []
+        self.old_concept_ids = []
+        for position in range(int(len(self.concept_ids) * history_ratio)):
+            old_id = FIRST_OLD_CONCEPT_ID + len(self.old_concept_ids)
+            self.old_concept_ids.append(old_id)
+            kind = position % 4
+            if kind == 0 and len(self.old_concept_ids) > 1:
+                self.history.append((old_id, self.old_concept_ids[-2]))
+            elif kind == 1:
+                self.history.extend((old_id, rng.choice(self.concept_ids)) for _ in range(2))
+            elif kind == 2:
+                self.history.append((old_id, None))
+            else:
+                self.history.append((old_id, rng.choice(self.concept_ids)))
+
+    def closure_pair_count(self):
+        return sum(len(ancestors) for ancestors in self.ancestors.values())
+
+    def write_sources(self, directory):
+        """Write tab-delimited SCT, SCTTC and SCTHIST exports and return their paths."""
+        os.makedirs(directory, exist_ok=True)
+        sct_path = os.path.join(directory, 'SCT.txt')
+        with open(sct_path, 'w', encoding='utf-8') as f:
+            f.write('TUI\tCUI\tTerm\n')
+            for concept_id in self.concept_ids + self.old_concept_ids:
+                f.write(f"{description_id(concept_id)}\t{concept_id}\t{preferred_term(concept_id)}\n")
+                f.write(f"{description_id(concept_id, synonym=True)}\t{concept_id}\tSynonym of {concept_id}\n")
+        tc_path = os.path.join(directory, 'SCTTC.txt')
+        with open(tc_path, 'w', encoding='utf-8') as f:
+            f.write('SupertypeID\tSubtypeID\n')
+            for concept_id, ancestors in self.ancestors.items():
+                f.writelines(f"{ancestor}\t{concept_id}\n" for ancestor in sorted(ancestors))
+        history_path = os.path.join(directory, 'SCTHIST.txt')
+        with open(history_path, 'w', encoding='utf-8') as f:
+            f.write('OLDCUI\tNEWCUI\n')
+            f.writelines(f"{old_id}\t{'' if new_id is None else new_id}\n" for old_id, new_id in self.history)
+        return sct_path, tc_path, history_path
+
+    def build_database(self, directory):
+        """Write the source exports and import them into an indexed SQLite database."""
+        sct_path, tc_path, history_path = self.write_sources(directory)
+        return build_sqlite_database(os.path.join(directory, 'terminology.sqlite'), sct_path, tc_path, history_path)
+
+def value_set_xml(terminology, rng, codes, exceptions, include_children_ratio, local_code_ratio, history_code_ratio):
+    values = []
+    excluded = []
+    for _ in range(codes):
+        if terminology.old_concept_ids and rng.random() < history_code_ratio:
+            concept_id = rng.choice(terminology.old_concept_ids)
+        else:
+            concept_id = rng.choice(terminology.concept_ids)
+        include_children = rng.random() < include_children_ratio
+        # EMIS local codes do not match a description, so the display name lookup is used
+        value = f"EMIS{concept_id}" if rng.random() < local_code_ratio else description_id(concept_id)
+        values.append(f"<values><value>{value}</value><displayName>{escape(preferred_term(concept_id))}</displayName>"
+                      f"<includeChildren>{'true' if include_children else 'false'}</includeChildren></values>")
+        if include_children and terminology.descendants.get(concept_id) and len(excluded) < exceptions:
+            excluded.append(rng.choice(terminology.descendants[concept_id]))
+    exception_xml = ''.join(f"<values><value>{concept_id}</value></values>" for concept_id in excluded)
+    return f"<valueSet>{''.join(values)}{f'<exception>{exception_xml}</exception>' if exception_xml else ''}</valueSet>"
+
+def write_emis_xml(path, terminology, reports=10, value_sets=4, codes=20, exceptions=2, include_children_ratio=0.5,
+                   local_code_ratio=0.1, history_code_ratio=0.05, seed=1):
+    """Write an EMIS search export with `reports` reports of `value_sets` value sets of `codes` codes each."""
+    rng = random.Random(seed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'<?xml version="1.0" encoding="utf-8"?><enquiryDocument xmlns="{EMIS_NAMESPACE}">')
+        for report in range(reports):
+            value_set_xmls = ''.join(value_set_xml(terminology, rng, codes, exceptions, include_children_ratio, local_code_ratio, history_code_ratio)
+                                     for _ in range(value_sets))
+            f.write(f"<report><name>Synthetic search {report} [BENCH{report:04d}]</name>"
+                    f"<population><criteriaGroup><definition><criteria>{value_set_xmls}</criteria></definition></criteriaGroup></population></report>")
+        f.write('</enquiryDocument>')
+    return path
@@ -0,0 +1,98 @@
+import time
+import logging
+import numpy as np
+
+logger = logging.getLogger("main_logger")
+
+LOAD_BATCH_SIZE = 100000
+
+def to_int_ids(values):
+    """Convert concept or description IDs to int64, returning the array and a mask of the values that were numeric."""
+    ids = np.zeros(len(values), dtype=np.int64)
+    valid = np.zeros(len(values), dtype=bool)
+    for position, value in enumerate(values):
+        try:
+            ids[position] = int(value)
+            valid[position] = True
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return ids, valid
+
+class ClosureIndex:
+    """The SCTTC transitive closure held in memory as CSR arrays.
+
+    `concept_ids` is the sorted array of supertype IDs, and the descendants of
+    `concept_ids[i]` are the sorted slice `descendants[offsets[i]:offsets[i + 1]]`.
+    An instance can be passed wherever a transitive closure connection is expected.
+    """
+
+    def __init__(self, concept_ids, offsets, descendants):
+        self.concept_ids = concept_ids
+        self.offsets = offsets
+        self.descendants = descendants
+
+    @classmethod
+    def from_pairs(cls, supertypes, subtypes):
+        """Build the index from parallel int64 arrays of (SupertypeID, SubtypeID) pairs."""
+        supertypes = np.asarray(supertypes, dtype=np.int64)
+        subtypes = np.asarray(subtypes, dtype=np.int64)
+        order = np.lexsort((subtypes, supertypes))
+        supertypes, subtypes = supertypes[order], subtypes[order]
+
+        # Drop duplicate pairs so each slice is strictly increasing
+        if len(supertypes):
+            keep = np.ones(len(supertypes), dtype=bool)
+            keep[1:] = (supertypes[1:] != supertypes[:-1]) | (subtypes[1:] != subtypes[:-1])
+            supertypes, subtypes = supertypes[keep], subtypes[keep]
+
+        concept_ids, starts = np.unique(supertypes, return_index=True)
+        offsets = np.append(starts, len(subtypes)).astype(np.int64)
+        return cls(concept_ids, offsets, subtypes)
+
+    @classmethod
+    def from_connection(cls, connection):
+        """Load SCTTC once from a terminology connection."""
+        start_time = time.time()
+        cursor = connection.cursor()
+        cursor.execute("SELECT SupertypeID, SubtypeID FROM SCTTC")
+        supertype_batches, subtype_batches = [], []
+        skipped = 0
+        while True:
+            rows = cursor.fetchmany(LOAD_BATCH_SIZE)
+            if not rows:
+                break
+            # Rows with a NULL or non-numeric ID can never match a lookup, so they are left out as in the snapshot
+            supertypes, supertype_valid = to_int_ids([row[0] for row in rows])
+            subtypes, subtype_valid = to_int_ids([row[1] for row in rows])
+            valid = supertype_valid & subtype_valid
+            skipped += len(rows) - int(valid.sum())
+            supertype_batches.append(supertypes[valid])
+            subtype_batches.append(subtypes[valid])
+
+        if supertype_batches:
+            index = cls.from_pairs(np.concatenate(supertype_batches), np.concatenate(subtype_batches))
+        else:
+            index = cls.from_pairs([], [])
+        if skipped:
+            logger.info(f"Skipped {skipped} SCTTC row{'s' if skipped != 1 else ''} without numeric concept IDs.")
+        logger.info(f"Loaded transitive closure into memory: {len(index.concept_ids)} concepts, "
+                    f"{len(index.descendants)} relationships in {time.time() - start_time:.2f} seconds.")
+        return index
+
+    def __len__(self):
+        return len(self.concept_ids)
+
+    def descendant_array(self, code):
+        """Return the sorted int64 descendants of `code` as an array view."""
+        try:
+            concept_id = int(code)
+        except (TypeError, ValueError):
+            return self.descendants[:0]
+        position = np.searchsorted(self.concept_ids, concept_id)
+        if position == len(self.concept_ids) or self.concept_ids[position] != concept_id:
+            return self.descendants[:0]
+        return self.descendants[self.offsets[position]:self.offsets[position + 1]]
+
+    def descendant_ids(self, code):
+        """Return the descendants of `code` as a set of concept ID strings."""
+        return set(map(str, self.descendant_array(code).tolist()))
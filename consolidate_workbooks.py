@@ -1,9 +1,18 @@
 import os
+import json
+import heapq
+import hashlib
+import pickle
+import shutil
+import tempfile
+import warnings
 import openpyxl
 import argparse
 import logging
-from openpyxl.worksheet.table import Table, TableStyleInfo
+from openpyxl.worksheet.table import Table, TableStyleInfo, TableColumn
+from openpyxl.worksheet.filters import AutoFilter
 from openpyxl.utils import get_column_letter
+from output_sinks import SINKS, read_sink_rows
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -13,6 +22,14 @@ formatter = logging.Formatter('%(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+HEADERS = ["Workbook", "Sheet", "Code", "Term"]
+SORT_RUN_SIZE = 100000
+SPILL_BATCH_SIZE = 1000
+CONSOLIDATED_FILE_NAME = "Consolidated_Workbook.xlsx"
+CACHE_DIR_NAME = ".consolidation_cache"
+MANIFEST_FILE_NAME = "manifest.json"
+MANIFEST_VERSION = 2
+
 def format_and_sort_worksheet(worksheet):
     # Sort the data based on columns 'A' and then 'B'
     data = worksheet.values
@@ -37,7 +54,92 @@ def format_and_sort_worksheet(worksheet):
         worksheet.column_dimensions[get_column_letter(column[0].column)].width = adjusted_width
 
 
-def consolidate_workbooks(source_dir, output_dir):
+def list_source_files(source_dir, source_format='xlsx'):
+    """Return the names of the report outputs in source_dir that consolidation reads."""
+    if source_format == 'xlsx':
+        return [file_name for file_name in os.listdir(source_dir) if file_name.endswith('.xlsx') and not file_name.startswith('~$')]
+    extension = SINKS[source_format].extension
+    return [file_name for file_name in os.listdir(source_dir) if file_name.startswith('snomed_codes_') and file_name.endswith(extension)]
+
+def iter_sink_file_rows(path, file_name, source_format):
+    """Yield [file, sheet, code, term] rows from one CSV, JSON Lines or Parquet report output."""
+    logger.info(f"Processing {source_format} output: {file_name}")
+    for row in read_sink_rows(path):
+        if row['code'] is not None and row['term'] is not None:
+            yield [file_name, str(row['value_set']), row['code'], row['term']]
+
+def iter_workbook_file_rows(workbook_path, file_name):
+    """Yield [workbook, sheet, code, term] rows from columns J and K of one workbook."""
+    wb = openpyxl.load_workbook(workbook_path, read_only=True)
+    logger.info(f"Processing workbook: {file_name}")
+    # Iterate through each sheet in the workbook
+    for sheet_name in wb.sheetnames:
+        ws = wb[sheet_name]
+        logger.info(f"Processing sheet: {sheet_name}")
+        # Assuming data starts from row 2, adjust if needed
+        for row in ws.iter_rows(min_row=2, max_col=11, values_only=True):
+            if len(row) < 11:
+                continue
+            code, term = row[9], row[10]  # Columns J and K
+            if code is not None and term is not None:
+                yield [file_name, sheet_name, code, term]
+    wb.close()
+
+def iter_file_rows(source_dir, file_name, source_format='xlsx'):
+    path = os.path.join(source_dir, file_name)
+    if source_format == 'xlsx':
+        return iter_workbook_file_rows(path, file_name)
+    return iter_sink_file_rows(path, file_name, source_format)
+
+def iter_source_rows(source_dir, source_format='xlsx'):
+    for file_name in list_source_files(source_dir, source_format):
+        yield from iter_file_rows(source_dir, file_name, source_format)
+
+def sort_key(row):
+    return (row[0], row[1])
+
+def write_rows_file(rows, path):
+    """Write rows to disk as a sequence of pickled batches. Only used for sort runs in a temporary directory that is removed before the process returns."""
+    with open(path, 'wb') as f:
+        for start in range(0, len(rows), SPILL_BATCH_SIZE):
+            pickle.dump(rows[start:start + SPILL_BATCH_SIZE], f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+def spill_sorted_run(rows, run_dir, run_index):
+    """Sort one run of rows and write it to disk, returning the run file path."""
+    rows.sort(key=sort_key)
+    return write_rows_file(rows, os.path.join(run_dir, f"run_{run_index}.pickle"))
+
+def read_rows_file(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+def external_sort(rows, run_dir, run_size=SORT_RUN_SIZE, on_row=None):
+    """Sort rows by workbook and sheet using sorted runs spilled to run_dir and a k-way merge.
+
+    The merge is stable, so the result matches sorted() on the same input. `on_row`
+    is called with each input row as it is read.
+    """
+    run_paths = []
+    run = []
+    for row in rows:
+        if on_row is not None:
+            on_row(row)
+        run.append(row)
+        if len(run) >= run_size:
+            run_paths.append(spill_sorted_run(run, run_dir, len(run_paths)))
+            run = []
+    if run:
+        run_paths.append(spill_sorted_run(run, run_dir, len(run_paths)))
+    # heapq.merge keeps equal keys in run order, and runs are in input order
+    return heapq.merge(*(read_rows_file(run_path) for run_path in run_paths), key=sort_key)
+
+def consolidate_workbooks(source_dir, output_dir, source_format='xlsx'):
     logger.info("Consolidating workbooks from directory: {}".format(source_dir))
     # Ensure the output directory exists
     if not os.path.exists(output_dir):
@@ -47,42 +149,188 @@ def consolidate_workbooks(source_dir, output_dir):
     consolidated_wb = openpyxl.Workbook()
     consolidated_ws = consolidated_wb.active
     consolidated_ws.title = "Consolidated Data"
-    consolidated_ws.append(["Workbook", "Sheet", "Code", "Term"])
-
-    # Iterate through each Excel file in the source directory
-    for file_name in os.listdir(source_dir):
-        if file_name.endswith('.xlsx') and not file_name.startswith('~$'):
-            workbook_path = os.path.join(source_dir, file_name)
-            wb = openpyxl.load_workbook(workbook_path)
-            logger.info(f"Processing workbook: {file_name}")
-            # Iterate through each sheet in the workbook
-            for sheet_name in wb.sheetnames:
-                ws = wb[sheet_name]
-                logger.info(f"Processing sheet: {sheet_name}")
-                # Assuming data starts from row 2, adjust if needed
-                for row in ws.iter_rows(min_row=2, max_col=11, values_only=True):
-                    code, term = row[9], row[10]  # Columns J and K
-                    if code is not None and term is not None:
-                        consolidated_ws.append([file_name, sheet_name, code, term])
-            wb.close()
+    consolidated_ws.append(HEADERS)
+
+    for row in iter_source_rows(source_dir, source_format):
+        consolidated_ws.append(row)
 
     # Sort and format the consolidated worksheet
     format_and_sort_worksheet(consolidated_ws)
     
     # Define the filename for the new workbook
-    output_file = os.path.join(output_dir, "Consolidated_Workbook.xlsx")
+    output_file = os.path.join(output_dir, CONSOLIDATED_FILE_NAME)
 
     # Save the new workbook
     consolidated_wb.save(output_file)
     logger.info(f"Consolidated workbook saved to: {output_file}")
 
+def consolidate_workbooks_streaming(source_dir, output_dir, source_format='xlsx', run_size=SORT_RUN_SIZE):
+    """Constant-memory equivalent of consolidate_workbooks.
+
+    Source workbooks are opened read-only, rows are sorted with an external merge
+    sort, and the result is written with openpyxl's write-only workbook.
+    """
+    logger.info("Consolidating workbooks from directory: {}".format(source_dir))
+    os.makedirs(output_dir, exist_ok=True)
+    write_consolidated_workbook(iter_source_rows(source_dir, source_format), output_dir, run_size)
+
+def write_consolidated_workbook(rows, output_dir, run_size=SORT_RUN_SIZE):
+    """Sort rows externally and write Consolidated_Workbook.xlsx with a write-only workbook.
+
+    Column widths are estimated while rows are read, since write-only sheets need
+    them before the first row is written.
+    """
+    max_lengths = [len(str(header)) for header in HEADERS]
+    row_count = 0
+
+    def measure(row):
+        nonlocal row_count
+        row_count += 1
+        for idx, value in enumerate(row):
+            max_lengths[idx] = max(max_lengths[idx], len(str(value)))
+
+    run_dir = tempfile.mkdtemp(prefix='consolidate_', dir=output_dir)
+    try:
+        sorted_rows = external_sort(rows, run_dir, run_size, on_row=measure)
+
+        consolidated_wb = openpyxl.Workbook(write_only=True)
+        consolidated_ws = consolidated_wb.create_sheet(title="Consolidated Data")
+        for idx, max_length in enumerate(max_lengths, 1):
+            consolidated_ws.column_dimensions[get_column_letter(idx)].width = max_length + 2
+
+        consolidated_ws.append(HEADERS)
+        for row in sorted_rows:
+            consolidated_ws.append(row)
+
+        # Apply table style
+        table_ref = f"A1:{get_column_letter(len(HEADERS))}{row_count + 1}"
+        tab = Table(displayName="Table1", ref=table_ref, autoFilter=AutoFilter(ref=table_ref))
+        style = TableStyleInfo(name="TableStyleMedium4", showFirstColumn=False,
+                               showLastColumn=False, showRowStripes=True, showColumnStripes=False)
+        tab.tableStyleInfo = style
+        # Write-only sheets cannot read the header cells back, so name the table columns explicitly
+        tab.tableColumns = [TableColumn(id=idx, name=header) for idx, header in enumerate(HEADERS, 1)]
+        with warnings.catch_warnings():
+            # openpyxl gives this reminder for every write-only table, even one whose columns are set
+            warnings.filterwarnings('ignore', message='In write-only mode you must add table columns manually', category=UserWarning)
+            consolidated_ws.add_table(tab)
+
+        output_file = os.path.join(output_dir, CONSOLIDATED_FILE_NAME)
+        consolidated_wb.save(output_file)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    logger.info(f"Consolidated {row_count} rows.")
+    logger.info(f"Consolidated workbook saved to: {output_file}")
+
+def write_part_file(rows, path):
+    """Write the cached rows of one source as JSON lines.
+
+    Part files persist in the output directory, so they are stored as data that is
+    parsed on the next run rather than pickles that would be executed.
+    """
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+    os.replace(path + '.tmp', path)
+    return path
+
+def read_part_file(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(cache_dir, source_format):
+    """Load the manifest of previously consolidated sources, or an empty one if it is missing or for another format."""
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILE_NAME)
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('source_format') != source_format:
+        return {}
+    return manifest.get('sources', {})
+
+def save_manifest(cache_dir, source_format, sources):
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILE_NAME)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'version': MANIFEST_VERSION, 'source_format': source_format, 'sources': sources}, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def consolidate_workbooks_incremental(source_dir, output_dir, source_format='xlsx', run_size=SORT_RUN_SIZE):
+    """Consolidate using cached rows for sources that have not changed since the last run.
+
+    A manifest in output_dir records the size, mtime and hash of every source along
+    with a cached part file of its extracted J/K rows. Only new or changed sources
+    are read again, parts of deleted sources are dropped, and the consolidated
+    workbook is rebuilt from the parts.
+    """
+    logger.info("Consolidating workbooks from directory: {}".format(source_dir))
+    cache_dir = os.path.join(output_dir, CACHE_DIR_NAME)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    previous_sources = load_manifest(cache_dir, source_format)
+    sources = {}
+    reused_count = read_count = 0
+    for file_name in sorted(list_source_files(source_dir, source_format)):
+        if file_name == CONSOLIDATED_FILE_NAME:
+            continue
+        path = os.path.join(source_dir, file_name)
+        stat = os.stat(path)
+        entry = previous_sources.get(file_name)
+        part_exists = entry is not None and os.path.exists(os.path.join(cache_dir, entry['part']))
+
+        if part_exists and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            sources[file_name] = entry
+            reused_count += 1
+            continue
+
+        current_hash = file_hash(path)
+        if part_exists and entry['hash'] == current_hash:
+            # Touched but unchanged
+            sources[file_name] = dict(entry, size=stat.st_size, mtime=stat.st_mtime_ns)
+            reused_count += 1
+            continue
+
+        part_name = hashlib.sha1(file_name.encode('utf-8')).hexdigest() + '.jsonl'
+        write_part_file(iter_file_rows(source_dir, file_name, source_format), os.path.join(cache_dir, part_name))
+        sources[file_name] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': current_hash, 'part': part_name}
+        read_count += 1
+
+    deleted_sources = set(previous_sources) - set(sources)
+    # Remove the parts of deleted sources, and any left by an earlier manifest version
+    part_names = {entry['part'] for entry in sources.values()}
+    for file_name in os.listdir(cache_dir):
+        if file_name != MANIFEST_FILE_NAME and file_name not in part_names:
+            os.remove(os.path.join(cache_dir, file_name))
+    save_manifest(cache_dir, source_format, sources)
+    logger.info(f"Read {read_count} new or changed source{'s' if read_count != 1 else ''}, reused {reused_count} unchanged, dropped {len(deleted_sources)} deleted.")
+
+    rows = (row for file_name in sources for row in read_part_file(os.path.join(cache_dir, sources[file_name]['part'])))
+    write_consolidated_workbook(rows, output_dir, run_size)
+
 def main():
     parser = argparse.ArgumentParser(description='Consolidate Workbooks')
     parser.add_argument('--source_dir', type=str, required=True, help='Source directory for workbooks')
     parser.add_argument('--output_dir', type=str, required=True, help='Output directory for the consolidated workbook')
+    parser.add_argument('--source_format', default='xlsx', choices=['xlsx'] + list(SINKS), help='Read report workbooks, or the csv/jsonl/parquet outputs written with --output_formats')
+    parser.add_argument('--streaming', action='store_true', help='Use read-only loading, an external merge sort and a write-only workbook to keep memory constant')
+    parser.add_argument('--incremental', action='store_true', help='Streaming consolidation that re-reads only new or changed sources, using a manifest kept in the output directory')
 
     args = parser.parse_args()
-    consolidate_workbooks(args.source_dir, args.output_dir)
+    if args.incremental:
+        consolidate_workbooks_incremental(args.source_dir, args.output_dir, args.source_format)
+    elif args.streaming:
+        consolidate_workbooks_streaming(args.source_dir, args.output_dir, args.source_format)
+    else:
+        consolidate_workbooks(args.source_dir, args.output_dir, args.source_format)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,57 @@
+import sys
+from collections import OrderedDict
+
+class DescendantCache:
+    """Run-wide LRU cache mapping a concept ID to the frozenset of its descendants.
+
+    Entries are evicted least recently used first once their estimated size
+    exceeds `max_bytes`. Hit and miss counts are kept for sizing the budget.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, code):
+        return code in self._entries
+
+    def get(self, code):
+        """Return the cached descendants of `code`, or None on a miss."""
+        entry = self._entries.get(code)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(code)
+        return entry[0]
+
+    def put(self, code, descendants):
+        descendants = frozenset(descendants)
+        size = sys.getsizeof(descendants) + sum(sys.getsizeof(item) for item in descendants)
+        if size > self.max_bytes:
+            return descendants
+
+        if code in self._entries:
+            self.current_bytes -= self._entries.pop(code)[1]
+        self._entries[code] = (descendants, size)
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+        return descendants
+
+    def stats_message(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0
+        return (f"Descendant cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+                f"{len(self._entries)} entries, {self.current_bytes / (1024 * 1024):.1f}/{self.max_bytes / (1024 * 1024):.0f} MB, "
+                f"{self.evictions} evictions.")
@@ -3,8 +3,6 @@ import tempfile
 import configparser
 import sys
 import logging
-import tkinter as tk
-from tkinter import filedialog
 
 # Create logger object
 logger = logging.getLogger("main_logger")
@@ -39,7 +37,8 @@ def load_config(config_file_path):
         return None
 
 def save_config(entries):
-    os.makedirs(os.path.dirname(config_file_path), exist_ok=True)
+    config_file_path = os.path.normpath(os.path.join(determine_application_path(), 'config.ini'))
+    config = load_config(config_file_path)
     config['DEFAULT'] = {
         'xml_directory': entries[0].get(),
         'database_path': entries[1].get(),
@@ -52,11 +51,6 @@ def save_config(entries):
         config.write(config_file)
     logger.info(f"Saved config to {config_file_path}")
 
-# Initialize directory and load config at file load
-application_path = determine_application_path()
-config_file_path = os.path.normpath(os.path.join(application_path, 'config.ini'))  # Normalize path
-config = load_config(config_file_path)
-
 def initialize_directory_structure():
     global xml_directory, database_path, transitive_closure_db_path, history_db_path, output_dir
     
@@ -79,17 +73,15 @@ def initialize_directory_structure():
     
     return config_file_path, script_path, xml_directory, database_path, transitive_closure_db_path, history_db_path, output_dir
 
-# Call the function to initialize and set global variables
-initialize_directory_structure()
-
 def select_directory(current_value="", file_mode=False):
     """Open a dialog to select a directory or file."""
+    from tkinter import filedialog
     initial_dir = os.path.dirname(current_value) if file_mode and current_value else current_value
     if not initial_dir:
         initial_dir = os.getcwd()  # default to current working directory if no initial directory is provided
 
     if file_mode:
-        path = filedialog.askopenfilename(initialdir=initial_dir, filetypes=[("Access Database", "*.mdb"), ("All Files", "*.*")])
+        path = filedialog.askopenfilename(initialdir=initial_dir, filetypes=[("Access Database", "*.mdb *.accdb"), ("SQLite Database", "*.sqlite *.sqlite3 *.db"), ("All Files", "*.*")])
     else:
         path = filedialog.askdirectory(initialdir=initial_dir)
     
@@ -97,7 +89,7 @@ def select_directory(current_value="", file_mode=False):
 
 def insert_path(entry, path):
     """Insert the path into the entry and move the cursor to the end."""
-    entry.delete(0, tk.END)
+    entry.delete(0, 'end')
     entry.insert(0, path)
     entry.xview_moveto(1)  # Move the internal view to the end
 
@@ -105,13 +97,13 @@ def validate_paths(entries):
     for entry in entries:
         path = entry.get()
         if not os.path.exists(path):
-            entry.delete(0, tk.END)
+            entry.delete(0, 'end')
 
 def validate_and_clear_invalid_paths(entry_widgets):
     for entry in entry_widgets:
         path = entry.get()
         if not os.path.exists(path):
-            entry.delete(0, tk.END)
+            entry.delete(0, 'end')
 
 def check_log_file_exists():
     global log_file_exists
@@ -1,36 +1,167 @@
 import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as XML_PARSER  # Optional faster parser with the same ElementTree API
+except ImportError:
+    XML_PARSER = ET
 import os
-import pyodbc
 import time
 import re
+import queue
 import logging
 import argparse
-from directory_functions import initialize_directory_structure
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
+import threading
+import functools
+from collections import deque, namedtuple
+from directory_functions import determine_application_path
+from terminology_backends import BACKENDS, connect_terminology, term_key
+from descendant_cache import DescendantCache
+from value_set_store import ValueSetStore, value_set_key, dedup_message
+from history_resolver import HistoryMap
+from output_sinks import SINKS, check_sink_dependencies, create_sink
+from pipeline_metrics import PipelineMetrics
+from log_events import JsonLinesHandler
+from run_manifest import RunManifest, hash_file, hash_value_sets
+from result_cache import terminology_fingerprint, ResultCache, NOT_FOUND, TUI_TO_CUI, TERM_TO_CUI, CUI_TO_TERM, DESCENDANTS
 
-# Argument parsing
+# Parse command-line arguments
 parser = argparse.ArgumentParser()
 parser.add_argument('--xml_directory', required=True)
-parser.add_argument('--database_path', required=True)
-parser.add_argument('--transitive_closure_db_path', required=True)
-parser.add_argument('--history_db_path', required=True)
+parser.add_argument('--database_path')
+parser.add_argument('--transitive_closure_db_path')
+parser.add_argument('--history_db_path')
 parser.add_argument('--output_dir', required=True)
+parser.add_argument('--backend', default='auto', choices=['auto'] + list(BACKENDS), help='Terminology backend; auto picks by file extension')
+parser.add_argument('--descendant_cache_mb', type=float, default=256, help='Memory budget for descendant sets reused across reports and files; 0 disables')
+parser.add_argument('--value_set_store_size', type=int, default=10000, help='Resolved value sets kept for reuse by identical value sets in later reports and files; 0 disables')
+parser.add_argument('--cache_dir', default=None, help='Directory for the persistent result cache (default: application directory)')
+parser.add_argument('--no_result_cache', action='store_true', help='Do not read or write the persistent result cache')
+parser.add_argument('--streaming', action='store_true', help='Parse XML files incrementally, one report at a time, to bound memory on very large exports')
+parser.add_argument('--write_only', action='store_true', help='Write workbooks with the constant-memory write-only writer')
+parser.add_argument('--output_formats', default='xlsx', help=f"Comma-separated outputs per report: xlsx, {', '.join(SINKS)}")
+parser.add_argument('--incremental', action='store_true', help='Skip XML files and reports whose value sets and terminology are unchanged since the last run, keeping their outputs')
+parser.add_argument('--workers', type=int, default=1, help='Number of worker processes; each opens its own terminology connections')
+parser.add_argument('--snapshot', default=None, help='Compiled terminology snapshot (terminology_backends.py compile-snapshot) to use instead of the three databases')
+parser.add_argument('--log_format', default='text', choices=['text', 'json'], help='Console log format; json writes batched JSON lines for the GUI')
+parser.add_argument('--log_level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING'], help='DEBUG adds per-code detail to the log')
+parser.add_argument('--watch', action='store_true', help='Keep running and process each XML file once it has been written to xml_directory')
+parser.add_argument('--watch_interval', type=float, default=2.0, help='Seconds between scans of xml_directory in watch mode; a file is processed once it is unchanged for one interval')
+parser.add_argument('--watch_queue', type=int, default=8, help='Settled files waiting to be processed in watch mode before scanning pauses')
+parser.add_argument('--closure_engine', default='database', choices=['database', 'memory'], help='Query SCTTC per code, or load it once into memory (requires numpy)')
 
-args = parser.parse_args()
+# Settings of the current run, set by configure()
+options = None
+xml_directory = None
+database_path = None
+transitive_closure_db_path = None
+history_db_path = None
+output_dir = None
+backend = 'auto'
+closure_engine = 'database'
+snapshot_path = None
+descendant_cache_mb = 256
+value_set_store_size = 10000
+value_set_store = None
+cache_dir = None
+use_result_cache = True
+streaming = False
+workers = 1
+write_only = False
+incremental = False
+output_formats = ['xlsx']
+run_manifest = None
+metrics = PipelineMetrics()
 
-# Extract the arguments
-xml_directory = args.xml_directory
-database_path = args.database_path
-transitive_closure_db_path = args.transitive_closure_db_path
-history_db_path = args.history_db_path
-output_dir = args.output_dir
+# Terminology resources of the current run, set by run_extraction() or init_worker()
+connection_main = connection_tc = connection_history = descendant_cache = result_cache = None
+
+# Held for the whole of each run: the settings and resources above belong to one run at a time
+run_lock = threading.RLock()
 
 # Constants
 IGNORED_VALUES = ['ACTIVE','REVIEW', 'ENDED', 'N/A', '385432009','C','U','R','RD','999011011000230107','12464001000001103', 'None']
 NAMESPACE = {'ns': 'http://www.e-mis.com/emisopen'}
+VALUE_SET_TAG = f"{{{NAMESPACE['ns']}}}valueSet"
+VALUES_TAG = f"{{{NAMESPACE['ns']}}}values"
+VALUE_TAG = f"{{{NAMESPACE['ns']}}}value"
+DISPLAY_NAME_TAG = f"{{{NAMESPACE['ns']}}}displayName"
+INCLUDE_CHILDREN_TAG = f"{{{NAMESPACE['ns']}}}includeChildren"
+EXCEPTION_TAG = f"{{{NAMESPACE['ns']}}}exception"
+RESOLUTION_HEADERS = ['Description ID', 'DisplayName', 'IncludeChildren', 'Concept ID from Description', 'Concept ID from DisplayName', 'Best Concept ID from Description or DisplayName', 'New Concept ID Exists']
+ALL_CONCEPTS_HEADERS = ['All Concepts including Children', 'Terms for All Concepts']
+
+# Handlers are added by main() when run as a script; in-process callers configure logging themselves
+logger = logging.getLogger("main_logger")
+
+# Files kept in metrics.json by --watch; older file nodes are dropped as new files are processed
+WATCH_METRICS_FILES = 100
+
+# Options that decide which terminology resources a run opens
+TERMINOLOGY_OPTIONS = ('database_path', 'transitive_closure_db_path', 'history_db_path', 'snapshot', 'backend', 'closure_engine', 'descendant_cache_mb', 'cache_dir', 'no_result_cache')
+TerminologyResources = namedtuple('TerminologyResources', ['connection_main', 'connection_tc', 'connection_history', 'descendant_cache', 'result_cache'])
+
+def one_run_at_a_time(function):
+    """Hold run_lock while `function` runs, so runs from other threads or pipelines wait instead of replacing its settings."""
+    @functools.wraps(function)
+    def locked(*args, **kwargs):
+        with run_lock:
+            return function(*args, **kwargs)
+    return locked
+
+def check_options(options):
+    """Raise ValueError if the options cannot describe a run."""
+    if not options.snapshot and not (options.database_path and options.transitive_closure_db_path and options.history_db_path):
+        raise ValueError("--database_path, --transitive_closure_db_path and --history_db_path are required unless --snapshot is given")
+    formats = [output_format.strip().lower() for output_format in options.output_formats.split(',') if output_format.strip()]
+    if unknown_formats := set(formats) - {'xlsx'} - set(SINKS):
+        raise ValueError(f"Unknown output format(s): {', '.join(sorted(unknown_formats))}")
+    if options.watch and options.workers > 1:
+        raise ValueError("--watch processes one file at a time and cannot be combined with --workers")
 
-def setup_logger(log_file_path):
+def parse_args(argv=None):
+    """Parse and check command-line arguments (sys.argv when `argv` is None)."""
+    options = parser.parse_args(argv)
+    try:
+        check_options(options)
+    except ValueError as e:
+        parser.error(str(e))
+    return options
+
+def make_options(xml_directory, output_dir, **settings):
+    """Build run options for in-process callers; `settings` use the command-line names, e.g. snapshot='terminology.snap', streaming=True."""
+    options = parser.parse_args(['--xml_directory', xml_directory, '--output_dir', output_dir])
+    for name, value in settings.items():
+        if not hasattr(options, name):
+            raise TypeError(f"Unknown extractor option: {name}")
+        setattr(options, name, value)
+    check_options(options)
+    return options
+
+def configure(run_options):
+    """Set the module settings used by the pipeline functions from parsed options."""
+    global options, xml_directory, database_path, transitive_closure_db_path, history_db_path, output_dir, backend, closure_engine, snapshot_path
+    global descendant_cache_mb, value_set_store_size, value_set_store, cache_dir, use_result_cache, streaming, workers, write_only, incremental, output_formats
+    options = run_options
+    xml_directory = run_options.xml_directory
+    database_path = run_options.database_path
+    transitive_closure_db_path = run_options.transitive_closure_db_path
+    history_db_path = run_options.history_db_path
+    output_dir = run_options.output_dir
+    backend = run_options.backend
+    closure_engine = run_options.closure_engine
+    snapshot_path = run_options.snapshot
+    descendant_cache_mb = run_options.descendant_cache_mb
+    value_set_store_size = run_options.value_set_store_size
+    # Each run starts with an empty store, as the terminology may have changed since the last one
+    value_set_store = ValueSetStore(value_set_store_size) if value_set_store_size > 0 else None
+    cache_dir = run_options.cache_dir or determine_application_path()
+    use_result_cache = not run_options.no_result_cache
+    streaming = run_options.streaming
+    workers = run_options.workers
+    write_only = run_options.write_only
+    incremental = run_options.incremental
+    output_formats = [output_format.strip().lower() for output_format in run_options.output_formats.split(',') if output_format.strip()]
+
+def setup_logger(log_format='text', log_level='INFO'):
     logger = logging.getLogger("main_logger")
     for handler in logger.handlers[:]:
         handler.close()
@@ -39,26 +170,14 @@ def setup_logger(log_file_path):
     # Formatter
     formatter = logging.Formatter('%(message)s')
         
-    # Stream handler
-    stream_handler = logging.StreamHandler()
+    # Stream handler: plain lines, or batched JSON lines for the GUI
+    stream_handler = JsonLinesHandler() if log_format == 'json' else logging.StreamHandler()
     stream_handler.setFormatter(formatter)
 
     logger.addHandler(stream_handler)
-    logger.setLevel(logging.INFO)
+    logger.setLevel(log_level)
     return logger
 
-log_file_path = os.path.join(output_dir, "log.txt")
-logger = setup_logger(log_file_path)
-
-start_time = time.time() #start clock
-
-# List XML files
-xml_files = [f for f in os.listdir(xml_directory) if f.endswith('.xml')]
-logger.info(f"Found {len(xml_files)} XML files in the directory: {xml_directory}")
-for file in xml_files:
-    logger.info(f"{file}")
-logger.info("-" * 40)
-
 def sanitize_filename(filename):
     """Remove characters that are illegal in filenames on Windows."""
     illegal_chars = r'<>:"/\|?*'
@@ -72,18 +191,101 @@ def process_single_report(data, report_name, database_path, transitive_closure_d
     
     # Create output folder if it doesn't exist
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    
+
+    total_value_sets = len(data)
+    resolved_value_sets = resolve_report_value_sets(data, connection_main, connection_tc, connection_history, descendant_cache, result_cache)
+    sinks = [create_sink(output_format, output_dir, report_name) for output_format in output_formats if output_format != 'xlsx'] if data else []
+    if sinks:
+        resolved_value_sets = write_to_sinks(resolved_value_sets, report_name, sinks)
+
     # Save the report data to the Excel file
-    processed_value_sets, total_value_sets = save_to_xlsx(data, output_file, connection_main, connection_tc, connection_history)
-    
+    if 'xlsx' in output_formats:
+        processed_value_sets = write_workbook(resolved_value_sets, output_file, write_only)
+    else:
+        processed_value_sets = sum(1 for _ in resolved_value_sets)
+    for sink in sinks:
+        sink.close()
+
+    output_paths = []
     if processed_value_sets > 0:
+        output_paths = ([output_file] if 'xlsx' in output_formats else []) + [sink.path for sink in sinks]
         logger.info(f"For report '{report_name}', successfully processed {processed_value_sets}/{total_value_sets} value sets.")
-        logger.info(f"Excel workbook saved to {output_file}\n")
+        if 'xlsx' in output_formats:
+            logger.info(f"Excel workbook saved to {output_file}")
+        for sink in sinks:
+            logger.info(f"{sink.extension.lstrip('.').upper()} output saved to {sink.path}")
+        logger.info("")
     else:
         logger.info(f"For report '{report_name}', no value sets were processed as they didn't contain any SNOMED-CT Concepts. No workbook saved.\n")
+    return output_paths
+
+def report_file_name(report):
+    """Use the bracketed ID in a report name if present, otherwise the sanitized report name."""
+    report_name = report.find(".//ns:name", NAMESPACE).text
+    name_content = report.find("ns:name", NAMESPACE).text
+    match = re.search(r'\[(.*?)\]', name_content)
+    report_name_sanitized = sanitize_filename(report_name)  # Sanitize the report name here
+    return match.group(1) if match else report_name_sanitized
+
+def process_report_element(report, database_path, transitive_closure_db_path, output_dir):
+    report_name = report.find(".//ns:name", NAMESPACE).text
+    file_name = report_file_name(report)
+    with metrics.scope('reports', report=file_name) as report_metrics:
+        logger.info(f"Processing report: {report_name}")
+        with metrics.stage('value_set_extraction'):
+            extracted_data = extract_values_single_pass(report)
+
+        if run_manifest is not None:
+            content_hash = hash_value_sets(extracted_data, sorted(output_formats))
+            if run_manifest.report_unchanged(file_name, content_hash):
+                run_manifest.reused_reports += 1
+                report_metrics['reused'] = True
+                logger.info(f"Report '{file_name}' is unchanged since the last run. Keeping existing outputs.\n")
+                return file_name
+
+        output_paths = process_single_report(extracted_data, file_name, database_path, transitive_closure_db_path, output_dir)
+        if run_manifest is not None:
+            run_manifest.record_report(file_name, content_hash, output_paths)
+            run_manifest.processed_reports += 1
+    return file_name
+
+def iter_report_elements(xml_path):
+    """Yield each report element of an XML file as soon as it has been parsed.
+
+    Parsed elements are detached from the tree once they have been yielded or
+    are known not to belong to a report, so memory is bounded by the largest
+    single report rather than the whole export.
+    """
+    report_tag = f"{{{NAMESPACE['ns']}}}report"
+    stack = []
+    report_depth = 0
+    for event, elem in XML_PARSER.iterparse(xml_path, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag == report_tag:
+                report_depth += 1
+            continue
+
+        stack.pop()
+        if elem.tag == report_tag:
+            report_depth -= 1
+            yield elem
+        if report_depth == 0 and stack:
+            elem.clear()
+            stack[-1].remove(elem)
+
+def extract_and_process_reports_from_xml_streaming(xml_path, database_path, transitive_closure_db_path, output_dir):
+    report_names = []
+    # Parsing is interleaved with processing, so it is timed report by report
+    for report in metrics.timed_iter(iter_report_elements(xml_path), 'xml_parse'):
+        report_names.append(process_report_element(report, database_path, transitive_closure_db_path, output_dir))
+    logger.info(f"Processed {len(report_names)} report{'s' if len(report_names) != 1 else ''}.")
+    logger.info("-" * 40)
+    return report_names
 
 def extract_and_process_reports_from_xml(xml_path, database_path, transitive_closure_db_path, output_dir):
-    tree = ET.parse(xml_path)
+    with metrics.stage('xml_parse'):
+        tree = XML_PARSER.parse(xml_path)
     root = tree.getroot()
 
     reports = root.findall(".//ns:report", NAMESPACE)
@@ -95,15 +297,7 @@ def extract_and_process_reports_from_xml(xml_path, database_path, transitive_clo
         logger.info(name)
     logger.info("-" * 40)  # Print separator for clarity
 
-    for report in reports:
-        report_name = report.find(".//ns:name", NAMESPACE).text 
-        logger.info(f"Processing report: {report_name}")
-        name_content = report.find("ns:name", NAMESPACE).text
-        match = re.search(r'\[(.*?)\]', name_content)
-        report_name_sanitized = sanitize_filename(report_name)  # Sanitize the report name here
-        report_name = match.group(1) if match else report_name_sanitized
-        extracted_data = extract_values_from_xml_element(report)
-        process_single_report(extracted_data, report_name, database_path, transitive_closure_db_path, output_dir)
+    return [process_report_element(report, database_path, transitive_closure_db_path, output_dir) for report in reports]
 
 def extract_values_from_xml_element(element):
     data_sets = []
@@ -142,18 +336,97 @@ def extract_values_from_xml_element(element):
 
     return [list(ds) for ds in data_sets]
 
+def scan_value_set(value_set):
+    """Walk a valueSet once, returning its (value, displayName, includeChildren) rows and exception codes.
+
+    Rows and exception codes match the `.//ns:values` and
+    `.//ns:exception//ns:values/ns:value` searches of extract_values_from_xml_element.
+    """
+    rows = []
+    exception_codes = set()
+    stack = [(value_set, False)]
+    while stack:
+        elem, in_exception = stack.pop()
+        children = [child for child in elem if isinstance(child.tag, str)]  # lxml exposes comments as children
+
+        if elem.tag == VALUES_TAG and elem is not value_set:
+            value = displayName = includeChildren = None
+            for child in children:
+                if child.tag == VALUE_TAG:
+                    if value is None:
+                        value = child
+                    if in_exception:
+                        exception_codes.add(child.text)
+                elif child.tag == DISPLAY_NAME_TAG and displayName is None:
+                    displayName = child
+                elif child.tag == INCLUDE_CHILDREN_TAG and includeChildren is None:
+                    includeChildren = child
+            rows.append((
+                value.text if value is not None else "N/A",
+                displayName.text if displayName is not None else "N/A",
+                includeChildren.text if includeChildren is not None else "false",
+            ))
+
+        child_in_exception = in_exception or (elem.tag == EXCEPTION_TAG and elem is not value_set)
+        stack.extend((child, child_in_exception) for child in reversed(children))
+    return rows, exception_codes
+
+def extract_values_single_pass(element):
+    """Single-traversal equivalent of extract_values_from_xml_element."""
+    data_sets = []
+    seen_data_sets = set()
+
+    for valueSet in element.iter(VALUE_SET_TAG):
+        if valueSet is element:
+            continue
+        rows, exception_codes = scan_value_set(valueSet)
+        exceptions = frozenset(exception_codes)
+        data = [(value, displayName, includeChildren, exceptions) for value, displayName, includeChildren in rows if value not in IGNORED_VALUES]
+
+        tuple_data = tuple(data)
+        if tuple_data not in seen_data_sets and len(data) > 0:
+            seen_data_sets.add(tuple_data)
+            data_sets.append(data)
+
+    logger.info(f"Extracted {len(data_sets)} datasets from the XML.")
+    for i, dataset in enumerate(data_sets, 1):
+        logger.info(f"Dataset {i}/{len(data_sets)} contains {len(dataset)} value{'s' if len(dataset) != 1 else ''}.")
+
+    return data_sets
+
 def chunk_list(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
-def get_cui_from_access(tui_list, display_names, connection_main):
+def take_cached(result_cache, namespace, keys, target):
+    """Copy cached results for `keys` into `target` and return the keys that still need a query."""
+    if result_cache is None:
+        return keys
+    cached = result_cache.get_many(namespace, keys)
+    target.update({key: value for key, value in cached.items() if value is not NOT_FOUND})
+    return [key for key in dict.fromkeys(keys) if key not in cached]
+
+def store_cached(result_cache, namespace, keys, results):
+    """Store query results for `keys`, remembering the keys that were not found."""
+    if result_cache is not None:
+        result_cache.put_many(namespace, {key: results[key] for key in keys if key in results}, missing=keys)
+
+def get_cui_from_access(tui_list, display_names, connection_main, result_cache=None):
     tui_to_cui = {}
     display_name_to_cui = {}
-    logger.info(f"Using the established connection to the database")
+    logger.debug(f"Using the established connection to the database")
 
     # Ensure that the TUI list has distinct values
     distinct_tui_list = list(set(tui_list))
+    distinct_tui_list = take_cached(result_cache, TUI_TO_CUI, distinct_tui_list, tui_to_cui)
+    display_names = take_cached(result_cache, TERM_TO_CUI, display_names, display_name_to_cui)
+
+    if hasattr(connection_main, 'cuis_for_tuis'):
+        # Terminology snapshot: lookups are searches over memory-mapped arrays
+        tui_to_cui.update(connection_main.cuis_for_tuis(distinct_tui_list))
+        display_name_to_cui.update(connection_main.cuis_for_terms(display_names))
+        distinct_tui_list = display_names = []
 
     # Chunk processing for TUI list
     for tui_chunk in chunk_list(distinct_tui_list, 500):
@@ -167,112 +440,291 @@ def get_cui_from_access(tui_list, display_names, connection_main):
         query_for_display_name = "SELECT Term, CUI FROM SCT WHERE Term IN ({})".format(','.join(['?'] * len(display_chunk)))
         cursor = connection_main.cursor()
         cursor.execute(query_for_display_name, display_chunk)
-        display_name_to_cui.update({row.Term: row.CUI for row in cursor.fetchall()})
+        # Terms match regardless of case, so map each row back to the display names as written in the XML
+        names_by_key = {}
+        for display_name in display_chunk:
+            names_by_key.setdefault(term_key(display_name), []).append(display_name)
+        for row in cursor.fetchall():
+            for display_name in names_by_key.get(term_key(row.Term), ()):
+                display_name_to_cui[display_name] = row.CUI
 
+    store_cached(result_cache, TUI_TO_CUI, distinct_tui_list, tui_to_cui)
+    store_cached(result_cache, TERM_TO_CUI, display_names, display_name_to_cui)
     return tui_to_cui, display_name_to_cui
 
 def get_all_children_from_database(code, connection, exceptions=None):
+    """Return `code` and its descendants, less each exception and the exception's own descendants."""
     if code is None:
         return set()
-        
-    if exceptions is None:
-        exceptions = set()
-    
-    children = {code}
-    newly_added = {code}
-    
-    loop_count = 0
+    exceptions = frozenset(exceptions or ())
+    return get_all_children_batch([(code, exceptions)], connection)[(code, exceptions)]
+
+def get_new_cui_from_history(old_cui_list, history_map):
+    """Map each old CUI to the tuple of final CUIs its SCTHIST chain resolves to (empty if retired without replacement)."""
+    if not old_cui_list:  # Check if the list is empty
+        return {}
 
-    while newly_added:
-        loop_count += 1
-        # Process the newly added set in chunks
-        temp_new_children = set()
-        for chunk in chunk_list(list(newly_added), 500):
-            query = "SELECT SubtypeID FROM SCTTC WHERE SupertypeID IN ({})".format(",".join(['?'] * len(chunk)))
-            cursor = connection.cursor()
-            cursor.execute(query, chunk)
-            temp_new_children.update({row.SubtypeID for row in cursor.fetchall()})
+    new_cui_map = history_map.new_cuis_for(old_cui_list)
 
-        # Remove the ones we already know about to avoid infinite loops
-        newly_added = temp_new_children - children
+    # Per-code details at DEBUG, one summary at INFO
+    if logger.isEnabledFor(logging.DEBUG):
+        for old_cui, new_cuis in new_cui_map.items():
+            if len(new_cuis) > 1:
+                logger.debug(f"Old Concept ID: {old_cui} has new Concept IDs: {', '.join(new_cuis)}")
+            elif new_cuis:
+                logger.debug(f"Old Concept ID: {old_cui} has a new Concept ID: {new_cuis[0]}")
+            else:
+                logger.debug(f"No new Concept ID found for: {old_cui}")
+    if new_cui_map:
+        replaced = sum(1 for new_cuis in new_cui_map.values() if new_cuis)
+        logger.info(f"History: {replaced} of {len(old_cui_list)} concept{'s' if len(old_cui_list) != 1 else ''} have a new Concept ID, "
+                    f"{len(new_cui_map) - replaced} inactive without a replacement.")
 
-        # Exclude exception codes
-        newly_added -= exceptions
+    return new_cui_map
 
-        # Add the newly discovered children to the main set
-        children.update(newly_added)
+def fetch_cui_and_display_maps(value_set_data, connection_main, result_cache=None):
+    tui_values = [entry[0] for entry in value_set_data]
+    display_names = list(dict.fromkeys(entry[1] for entry in value_set_data))
+    return get_cui_from_access(tui_values, display_names, connection_main, result_cache)
 
-        if excluded_codes := newly_added.intersection(exceptions):
-            logger.info(f"Excluded child codes for {code}: {', '.join(map(str, excluded_codes))}")
+def prefetch_report_ids(data, connection_main, connection_history, result_cache=None):
+    """Look up the Concept IDs and history replacements for every value set of a report in one bulk pass.
 
-    # Logging information about the operation
-    additional_msg = ". No child codes found." if len(children) == 1 else f". Found {len(children) - 1} child codes." if len(children) > 1 else ""
-    logger.info(f"Fetching children for code {code} completed in {loop_count} iteration{'s' if loop_count > 1 else ''}{additional_msg}")
+    The maps are shared by all value sets, so a code repeated across value sets is only queried once.
+    """
+    report_entries = [entry for value_set_data in data for entry in value_set_data]
+    with metrics.stage('tui_term_lookup'):
+        tui_to_cui_map, display_name_to_cui_map = fetch_cui_and_display_maps(report_entries, connection_main, result_cache)
+    all_final_ids = []
 
-    return children
+    # Populate all_final_ids here
+    for value, display_name, include_children, exceptions in report_entries:
+        cui_value, display_name_cui_value, final_id = fetch_cui_values(tui_to_cui_map, display_name_to_cui_map, value, display_name)
 
-def get_new_cui_from_history(old_cui_list, connection_history):
-    if not old_cui_list:  # Check if the list is empty
-        return {}
+        if final_id is not None and final_id != "Not Found":
+            all_final_ids.append(final_id)
 
-    new_cui_map = {}
+    # Fetch new CUIs based on history after populating all_final_ids
+    with metrics.stage('history_lookup'):
+        new_cui_map = get_new_cui_from_history(list(dict.fromkeys(all_final_ids)), connection_history)
+    logger.info(f"Prefetched Concept IDs for {len(report_entries)} value{'s' if len(report_entries) != 1 else ''} across {len(data)} value set{'s' if len(data) != 1 else ''}.")
+    return tui_to_cui_map, display_name_to_cui_map, new_cui_map
+
+def collect_children_requests(data, value_set_ids):
+    """Return every (code, exceptions) pair whose children are needed across all value sets of a report."""
+    requests = []
+    for value_set_data, (tui_to_cui_map, display_name_to_cui_map, new_cui_map) in zip(data, value_set_ids):
+        for value, display_name, include_children, exceptions in value_set_data:
+            if include_children != "true":
+                continue
+            cui_value, display_name_cui_value, final_id = fetch_cui_values(tui_to_cui_map, display_name_to_cui_map, value, display_name)
+            for code in (final_id, *new_cui_map.get(final_id, ())):
+                if code is not None and code != "Not Found":
+                    requests.append((code, exceptions))
+    return requests
 
-    # Chunk processing for old CUI list
-    for cui_chunk in chunk_list(old_cui_list, 500):
-        placeholders = ', '.join('?' for _ in cui_chunk)
-        query = f"SELECT OLDCUI, NEWCUI FROM SCTHIST WHERE OLDCUI IN ({placeholders})"
-        cursor = connection_history.cursor()
-        cursor.execute(query, cui_chunk)
-        results = {row.OLDCUI: row.NEWCUI for row in cursor.fetchall()}
+def get_all_children_batch(requests, connection, descendant_cache=None, result_cache=None):
+    """Resolve the children of many (code, exceptions) pairs at once.
 
-        # Update the new CUI map with results from this chunk
-        new_cui_map.update(results)
+    SCTTC is already a transitive closure, so each distinct code needs a single
+    lookup and the codes are sent in chunks rather than walked generation by generation.
+    Codes already in `descendant_cache` or `result_cache` are not looked up again.
 
-    # Log details about the history lookups
-    for old_cui, new_cui in new_cui_map.items():
-        if new_cui:
-            logger.info(f"Old Concept ID: {old_cui} has a new Concept ID: {new_cui}")
+    The children of a pair are descendants(code) minus each exception and its
+    descendants, so a concept below an excluded one is excluded even when it is
+    also reached through another parent. Exception codes are looked up in the
+    same chunks as the codes themselves.
+    """
+    codes = list(dict.fromkeys(code for code, _ in requests))
+    exception_codes = list(dict.fromkeys(code for _, exceptions in requests for code in exceptions))
+    lookup_codes = list(dict.fromkeys(codes + exception_codes))
+    descendants = {}
+    pending_codes = []
+    for code in lookup_codes:
+        cached = descendant_cache.get(code) if descendant_cache is not None else None
+        if cached is None:
+            pending_codes.append(code)
         else:
-            logger.info(f"No new Concept ID found for: {old_cui}")
+            descendants[code] = cached
+    persisted = {}
+    pending_codes = take_cached(result_cache, DESCENDANTS, pending_codes, persisted)
+    for code, code_descendants in persisted.items():
+        descendants[code] = descendant_cache.put(code, code_descendants) if descendant_cache is not None else set(code_descendants)
+    query_count = 0
 
-    return new_cui_map
+    if hasattr(connection, 'descendant_ids'):
+        found = {code: connection.descendant_ids(code) for code in pending_codes}
+    else:
+        found = {code: set() for code in pending_codes}
+        codes_by_key = {str(code): code for code in pending_codes}
+        for chunk in chunk_list(pending_codes, 500):
+            query = "SELECT SupertypeID, SubtypeID FROM SCTTC WHERE SupertypeID IN ({})".format(",".join(['?'] * len(chunk)))
+            try:
+                cursor = connection.cursor()
+                cursor.execute(query, chunk)
+                query_count += 1
+                for row in cursor.fetchall():
+                    found[codes_by_key[str(row.SupertypeID)]].add(row.SubtypeID)
+            except Exception as e:
+                logger.info(f"Did not include child codes for {', '.join(map(str, chunk))}: {e}")
+                for code in chunk:
+                    descendants[code] = found.pop(code)
 
-def fetch_cui_and_display_maps(value_set_data, connection_main):
-    tui_values = [entry[0] for entry in value_set_data]
-    display_names = [entry[1] for entry in value_set_data]
-    return get_cui_from_access(tui_values, display_names, connection_main)
+    for code, code_descendants in found.items():
+        descendants[code] = descendant_cache.put(code, code_descendants) if descendant_cache is not None else code_descendants
+    if result_cache is not None and not hasattr(connection, 'descendant_ids'):
+        result_cache.put_many(DESCENDANTS, {code: sorted(code_descendants) for code, code_descendants in found.items()})
 
-def process_value_set(value_set_data, ws, connection_main, connection_tc, connection_history, checked_cuis):
-    tui_to_cui_map, display_name_to_cui_map = fetch_cui_and_display_maps(value_set_data, connection_main)
-    all_codes_column, all_final_ids = set(), []
-    
-    # Populate all_final_ids here
-    for entry in value_set_data:
-        value, display_name, include_children, exceptions = entry
-        cui_value, display_name_cui_value, final_id = fetch_cui_values(tui_to_cui_map, display_name_to_cui_map, value, display_name)
+    resolved = {}
+    excluded_subtrees = {}
+    excluded_count = 0
+    log_details = logger.isEnabledFor(logging.DEBUG)
+    for code, exceptions in requests:
+        if (code, exceptions) in resolved:
+            continue
+        if exceptions not in excluded_subtrees:
+            excluded_subtrees[exceptions] = set(exceptions).union(*(descendants[exception] for exception in exceptions))
+        children = {code} | (descendants[code] - excluded_subtrees[exceptions])
+        resolved[(code, exceptions)] = children
 
-        if final_id is not None:  # Check to ensure final_id is not None before appending
-            all_final_ids.append(final_id)
-    
-    # Fetch new CUIs based on history after populating all_final_ids
-    new_cui_map = get_new_cui_from_history(all_final_ids, connection_history)
+        if excluded_codes := descendants[code].intersection(excluded_subtrees[exceptions]):
+            excluded_count += len(excluded_codes)
+            if log_details:
+                logger.debug(f"Excluded child codes for {code}: {', '.join(map(str, excluded_codes))}")
+        if log_details:
+            additional_msg = ". No child codes found." if len(children) == 1 else f". Found {len(children) - 1} child codes."
+            logger.debug(f"Fetching children for code {code} completed{additional_msg}")
+
+    if codes:
+        source = "memory" if hasattr(connection, 'descendant_ids') else f"{query_count} quer{'ies' if query_count != 1 else 'y'}"
+        exceptions_msg = f" and {len(exception_codes)} exception{'s' if len(exception_codes) != 1 else ''}" if exception_codes else ""
+        cached_msg = f" ({len(lookup_codes) - len(pending_codes)} from cache)" if descendant_cache is not None or result_cache is not None else ""
+        excluded_msg = f", {excluded_count} excluded by exceptions" if excluded_count else ""
+        logger.info(f"Resolved children for {len(codes)} code{'s' if len(codes) != 1 else ''}{exceptions_msg}{cached_msg} in {source}{excluded_msg}.")
+    return resolved
+
+ResolvedValueSet = namedtuple('ResolvedValueSet', ['index', 'value_set_data', 'value_set_ids', 'resolved_children', 'resolution_rows', 'all_codes_column', 'code_to_term_map'])
+
+def trim_resolved(resolved):
+    """Keep only the parts of the report-wide maps that a value set uses, so stored value sets do not hold whole reports."""
+    tui_to_cui_map, display_name_to_cui_map, new_cui_map = resolved.value_set_ids
+    final_ids = [fetch_cui_values(tui_to_cui_map, display_name_to_cui_map, value, display_name)[2] for value, display_name, _, _ in resolved.value_set_data]
+    value_set_ids = (
+        {value: tui_to_cui_map[value] for value, _, _, _ in resolved.value_set_data if value in tui_to_cui_map},
+        {display_name: display_name_to_cui_map[display_name] for _, display_name, _, _ in resolved.value_set_data if display_name in display_name_to_cui_map},
+        {final_id: new_cui_map[final_id] for final_id in final_ids if final_id in new_cui_map},
+    )
+    requests = collect_children_requests([resolved.value_set_data], [value_set_ids])
+    resolved_children = {request: resolved.resolved_children[request] for request in requests if request in resolved.resolved_children}
+    return resolved._replace(value_set_ids=value_set_ids, resolved_children=resolved_children)
+
+def resolve_report_value_sets(data, connection_main, connection_tc, connection_history, descendant_cache=None, result_cache=None):
+    """Resolve the value sets of a report, yielding a ResolvedValueSet for each one in turn.
+
+    A value set already resolved earlier in the run, in this or another report, is taken
+    from the value set store. For the rest, descriptions, display names, history, children
+    and terms are each fetched once for the whole report, and every value set is then
+    filled in from those shared maps.
+    """
+    resolved_value_sets = {}
+    keys = {}
+    if value_set_store is not None:
+        for idx, value_set_data in enumerate(data, 1):
+            keys[idx] = value_set_key(value_set_data)
+            if (stored := value_set_store.get(keys[idx])) is not None:
+                resolved_value_sets[idx] = stored._replace(index=idx)
+                metrics.value_set(idx, values=len(value_set_data), concepts=len(stored.all_codes_column), deduplicated=True)
+    new_value_sets = [(idx, value_set_data) for idx, value_set_data in enumerate(data, 1) if idx not in resolved_value_sets]
+
+    if new_value_sets:
+        new_data = [value_set_data for _, value_set_data in new_value_sets]
+        ids = prefetch_report_ids(new_data, connection_main, connection_history, result_cache)
+        value_set_ids = [ids] * len(new_data)
+        with metrics.stage('closure_expansion'):
+            resolved_children = get_all_children_batch(collect_children_requests(new_data, value_set_ids), connection_tc, descendant_cache, result_cache)
+
+        tui_to_cui_map, display_name_to_cui_map, new_cui_map = ids
+        value_set_rows = []
+        for idx, value_set_data in new_value_sets:
+            value_set_metrics = metrics.value_set(idx, values=len(value_set_data))
+            with metrics.stage('value_set_rows', value_set_metrics):
+                resolution_rows, all_codes_column, all_final_ids = [], set(), []
+                populate_worksheet(resolution_rows, value_set_data, tui_to_cui_map, display_name_to_cui_map, new_cui_map, all_codes_column, all_final_ids, resolved_children)
+            value_set_metrics['concepts'] = len(all_codes_column)
+            value_set_rows.append((resolution_rows, all_codes_column))
+        with metrics.stage('term_fetch'):
+            report_terms = fetch_all_terms(set().union(*(all_codes_column for _, all_codes_column in value_set_rows)), connection_main, result_cache)
+
+        for (idx, value_set_data), (resolution_rows, all_codes_column) in zip(new_value_sets, value_set_rows):
+            code_to_term_map = {code: term for code, term in report_terms.items() if code in all_codes_column}
+            resolved_value_sets[idx] = ResolvedValueSet(idx, value_set_data, ids, resolved_children, resolution_rows, all_codes_column, code_to_term_map)
+            if value_set_store is not None:
+                value_set_store.put(keys[idx], trim_resolved(resolved_value_sets[idx]))
+    if len(resolved_value_sets) > len(new_value_sets):
+        reused = len(resolved_value_sets) - len(new_value_sets)
+        logger.info(f"Reused {reused} of {len(data)} value set{'s' if len(data) != 1 else ''} resolved earlier in the run.")
 
-    populate_worksheet(ws, value_set_data, tui_to_cui_map, display_name_to_cui_map, new_cui_map, all_codes_column, all_final_ids, connection_tc, checked_cuis)
-    write_all_concepts_to_columns(ws, all_codes_column, connection_main)
-    return len(all_codes_column)
+    for idx in range(1, len(data) + 1):
+        yield resolved_value_sets[idx]
 
-def populate_worksheet(ws, value_set_data, tui_to_cui_map, display_name_to_cui_map, new_cui_map, all_codes_column, all_final_ids, connection_tc, checked_cuis):
-    # Main loop to populate worksheet
+def iter_concept_rows(report_name, resolved):
+    """Yield sink rows (report, value_set, code, term, source_value, provenance) for the J/K concepts of a value set.
+
+    Provenance is 'concept' for a code matched directly from the XML, 'history' for
+    a replacement from SCTHIST, and 'child' for a descendant added by includeChildren.
+    """
+    tui_to_cui_map, display_name_to_cui_map, new_cui_map = resolved.value_set_ids
+    sources = {}
+    for provenance in ('concept', 'history', 'child'):
+        for value, display_name, include_children, exceptions in resolved.value_set_data:
+            cui_value, display_name_cui_value, final_id = fetch_cui_values(tui_to_cui_map, display_name_to_cui_map, value, display_name)
+            new_cuis = new_cui_map.get(final_id, ())
+            if provenance == 'concept' and final_id != "Not Found":
+                sources.setdefault(final_id, (value, provenance))
+            elif provenance != 'concept' and include_children == "true":
+                for code in filter(lambda x: x is not None and x != "Not Found", [final_id, *new_cuis]):
+                    if provenance == 'history' and code in new_cuis:
+                        sources.setdefault(code, (value, provenance))
+                    elif provenance == 'child':
+                        for child in resolved.resolved_children.get((code, exceptions), ()):
+                            sources.setdefault(child, (value, provenance))
+
+    for code, term in resolved.code_to_term_map.items():
+        if code in resolved.all_codes_column:
+            source_value, provenance = sources.get(code, (None, None))
+            yield (report_name, resolved.index, code, term, source_value, provenance)
+
+def write_to_sinks(resolved_value_sets, report_name, sinks):
+    """Pass resolved value sets through unchanged after writing their concept rows to each sink."""
+    for resolved in resolved_value_sets:
+        with metrics.stage('sink_write', metrics.value_set(resolved.index)):
+            rows = list(iter_concept_rows(report_name, resolved))
+            for sink in sinks:
+                sink.write_rows(rows)
+        yield resolved
+
+def iter_sheet_rows(resolution_rows, code_to_term_map, all_codes_column):
+    """Yield data rows with the A–G resolution rows alongside the J/K concept rows, matching populate_columns_j_and_k."""
+    concept_rows = [(code, term) if code in all_codes_column else None for code, term in code_to_term_map.items()]
+    for idx in range(max(len(resolution_rows), len(concept_rows))):
+        row = list(resolution_rows[idx]) if idx < len(resolution_rows) else [None] * len(RESOLUTION_HEADERS)
+        concept_row = concept_rows[idx] if idx < len(concept_rows) else None
+        if concept_row is not None:
+            row += [None, None, concept_row[0], concept_row[1]]
+        yield row
+
+def populate_worksheet(resolution_rows, value_set_data, tui_to_cui_map, display_name_to_cui_map, new_cui_map, all_codes_column, all_final_ids, resolved_children):
+    # Main loop to fill the resolution rows (columns A-G)
     for entry in value_set_data:
         value, display_name, include_children, exceptions = entry
         cui_value, display_name_cui_value, final_id = fetch_cui_values(tui_to_cui_map, display_name_to_cui_map, value, display_name)
-        new_cui = new_cui_map.get(final_id)
+        new_cuis = new_cui_map.get(final_id, ())
 
         if final_id is not None and final_id != "Not Found":  # Check to ensure final_id is not "Not Found" before appending
             all_final_ids.append(final_id)
         
-        ws.append([value, display_name, include_children, cui_value, display_name_cui_value, final_id, new_cui if new_cui else "N/A"])
-        handle_children_and_update_codes(all_codes_column, final_id, new_cui, include_children, connection_tc, exceptions, checked_cuis)
+        resolution_rows.append([value, display_name, include_children, cui_value, display_name_cui_value, final_id, ', '.join(new_cuis) if new_cuis else "N/A"])
+        handle_children_and_update_codes(all_codes_column, final_id, new_cuis, include_children, resolved_children, exceptions)
 
         if final_id != "Not Found":
             all_final_ids.append(final_id)
@@ -283,34 +735,30 @@ def fetch_cui_values(tui_to_cui_map, display_name_to_cui_map, value, display_nam
     final_id = cui_value if cui_value != "Not Found" else display_name_cui_value
     return cui_value, display_name_cui_value, final_id
 
-def handle_children_and_update_codes(all_codes_column, final_id, new_cui, include_children, connection_tc, exceptions, checked_cuis):
+def handle_children_and_update_codes(all_codes_column, final_id, new_cuis, include_children, resolved_children, exceptions):
     if final_id != "Not Found":
         all_codes_column.add(final_id)
-        checked_cuis.add(final_id)
     
     if include_children == "true":
         # Existing and potential new Concept IDs
-        for code in filter(lambda x: x != "Not Found", [final_id, new_cui]):
-            try:
-                children = get_all_children_from_database(code, connection_tc, exceptions=exceptions)
-                all_codes_column.update(children)
-            except Exception as e:
-                logger.info(f"Did not include child codes for {code}: {e}")
-
-def write_all_concepts_to_columns(ws, all_codes_column, connection_main):
-    ws['J1'], ws['K1'] = 'All Concepts including Children', 'Terms for All Concepts'
-    code_to_term_map = fetch_all_terms(all_codes_column, connection_main)
-    populate_columns_j_and_k(ws, code_to_term_map, all_codes_column)
+        for code in filter(lambda x: x is not None and x != "Not Found", [final_id, *new_cuis]):
+            all_codes_column.update(resolved_children.get((code, exceptions), {code}))
 
-def fetch_all_terms(all_codes_column, connection_main):
+def fetch_all_terms(all_codes_column, connection_main, result_cache=None):
     # Fetch terms for all_codes_column with chunking
     code_to_term_map = {}
-    for code_chunk in chunk_list(list(all_codes_column), 500):
+    uncached_codes = take_cached(result_cache, CUI_TO_TERM, list(all_codes_column), code_to_term_map)
+    if hasattr(connection_main, 'terms_for_cuis'):
+        code_to_term_map.update(connection_main.terms_for_cuis(uncached_codes))
+        uncached_codes = []
+    for code_chunk in chunk_list(uncached_codes, 500):
         query = f"SELECT CUI, Term FROM SCT WHERE CUI IN ({','.join(['?'] * len(code_chunk))})"
         cursor_main = connection_main.cursor()
         cursor_main.execute(query, code_chunk)
         code_to_term_map.update({row.CUI: row.Term for row in cursor_main.fetchall()})
-    return code_to_term_map
+    store_cached(result_cache, CUI_TO_TERM, uncached_codes, code_to_term_map)
+    # Sorted so the row order of columns J/K does not depend on which terms came from the cache
+    return {code: code_to_term_map[code] for code in sorted(code_to_term_map, key=str)}
 
 def populate_columns_j_and_k(ws, code_to_term_map, all_codes_column):
     for idx, (code, term) in enumerate(code_to_term_map.items(), start=2):
@@ -318,59 +766,445 @@ def populate_columns_j_and_k(ws, code_to_term_map, all_codes_column):
             ws[f'J{idx}'] = code
             ws[f'K{idx}'] = term
 
-def save_to_xlsx(data, file_path, connection_main, connection_tc, connection_history):
-    total_value_sets = len(data)
-    wb = Workbook()
-    wb.remove(wb.active) 
-    
-    checked_cuis = set()
-    for idx, value_set_data in enumerate(data, 1):
-        ws = wb.create_sheet(title=str(idx))
-        ws.append(['Description ID', 'DisplayName', 'IncludeChildren', 'Concept ID from Description', 'Concept ID from DisplayName', 'Best Concept ID from Description or DisplayName', 'New Concept ID Exists'])
-        
-        process_value_set(value_set_data, ws, connection_main, connection_tc, connection_history, checked_cuis)
-    
+def write_workbook(resolved_value_sets, file_path, write_only=False):
+    """Write one sheet per resolved value set and return the number of sheets saved."""
+    from openpyxl import Workbook  # Imported on first use; it dominates the extractor's import time
+    if write_only:
+        # Constant-memory writer: rows are streamed to disk as each sheet is appended
+        wb = Workbook(write_only=True)
+    else:
+        wb = Workbook()
+        wb.remove(wb.active) 
+
+    for resolved in resolved_value_sets:
+        with metrics.stage('sheet_write', metrics.value_set(resolved.index)):
+            ws = wb.create_sheet(title=str(resolved.index))
+            if write_only:
+                # Rows A–G and the J/K columns are emitted together, row by row
+                ws.append(RESOLUTION_HEADERS + [None, None] + ALL_CONCEPTS_HEADERS)
+                for row in iter_sheet_rows(resolved.resolution_rows, resolved.code_to_term_map, resolved.all_codes_column):
+                    ws.append(row)
+                continue
+            ws.append(RESOLUTION_HEADERS)
+            for row in resolved.resolution_rows:
+                ws.append(row)
+            ws['J1'], ws['K1'] = ALL_CONCEPTS_HEADERS
+            populate_columns_j_and_k(ws, resolved.code_to_term_map, resolved.all_codes_column)
+
     if not wb.worksheets:
-        return 0, 0
-    wb.save(file_path)
-    return len(wb.worksheets), total_value_sets
+        return 0
+    with metrics.stage('workbook_save'):
+        wb.save(file_path)
+    return len(wb.worksheets)
 
-if __name__ == "__main__":
-    
-    connection_str_main = (
-        r'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};'
-        f'DBQ={database_path};'
-    )
-    connection_main = pyodbc.connect(connection_str_main)
+def save_to_xlsx(data, file_path, connection_main, connection_tc, connection_history, descendant_cache=None, result_cache=None, write_only=False):
+    total_value_sets = len(data)
+    resolved_value_sets = resolve_report_value_sets(data, connection_main, connection_tc, connection_history, descendant_cache, result_cache)
+    return write_workbook(resolved_value_sets, file_path, write_only), total_value_sets
 
-    connection_str_tc = (
-    r'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};'
-    f'DBQ={transitive_closure_db_path};'
-    )
-    connection_tc = pyodbc.connect(connection_str_tc)
+def open_terminology_resources():
+    """Open the terminology connections and caches used by process_single_report."""
+    descendant_cache = DescendantCache(int(descendant_cache_mb * 1024 * 1024)) if descendant_cache_mb > 0 else None
+    if snapshot_path:
+        # The snapshot answers every lookup from memory, so the result cache is not needed
+        from terminology_snapshot import TerminologySnapshot
+        with metrics.stage('snapshot_open'):
+            snapshot = TerminologySnapshot(snapshot_path)
+        return TerminologyResources(snapshot, snapshot, snapshot, descendant_cache, None)
 
-    connection_str_history = (
-    r'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};'
-    f'DBQ={history_db_path};'
-    )
-    connection_history = pyodbc.connect(connection_str_history) 
+    # Queries on each connection are counted for metrics.json
+    connection_main = metrics.count_queries(connect_terminology(database_path, backend), 'main')
+    connection_tc = metrics.count_queries(connect_terminology(transitive_closure_db_path, backend), 'transitive_closure')
+    if closure_engine == 'memory':
+        from closure_engine import ClosureIndex
+        connection_tc_db = connection_tc
+        with metrics.stage('closure_load'):
+            connection_tc = ClosureIndex.from_connection(connection_tc_db)
+        connection_tc_db.close()
+    # SCTHIST chains are resolved once per release into a map of final replacement concepts
+    connection_history_db = metrics.count_queries(connect_terminology(history_db_path, backend), 'history')
+    with metrics.stage('history_map_load'):
+        if use_result_cache:
+            connection_history = HistoryMap.open_for(cache_dir, history_db_path, connection_history_db)
+        else:
+            connection_history = HistoryMap.from_connection(connection_history_db)
+    connection_history_db.close()
 
-    # Ensure output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Extract and process reports from the XML
-    for xml_file in os.listdir(xml_directory):
-        if xml_file.endswith(".xml"):
-            xml_path = os.path.join(xml_directory, xml_file)
-            base_name = os.path.basename(xml_path).replace(".xml", "")
-            logger.info(f"Starting to process: {xml_file}")
-            extract_and_process_reports_from_xml(xml_path, database_path, transitive_closure_db_path, output_dir)
-    
+    result_cache = ResultCache.open_for(cache_dir, database_path, transitive_closure_db_path, history_db_path) if use_result_cache else None
+    return TerminologyResources(connection_main, connection_tc, connection_history, descendant_cache, result_cache)
+
+def close_terminology_resources(connection_main, connection_tc, connection_history, result_cache):
+    if result_cache is not None:
+        result_cache.close()
     connection_main.close()
-    connection_tc.close()
+    if hasattr(connection_tc, 'close'):
+        connection_tc.close()
     connection_history.close()
+
+class BufferedLogHandler(logging.Handler):
+    """Collect log lines in a worker process so they can be replayed in order by the parent."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, self.format(record)))
+
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+worker_log_handler = None
+
+def init_worker(run_options):
+    """Process pool initializer: buffer log output and open this worker's own terminology connections."""
+    global connection_main, connection_tc, connection_history, descendant_cache, result_cache, worker_log_handler, run_manifest, metrics
+    configure(run_options)
+    metrics = PipelineMetrics()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    worker_log_handler = BufferedLogHandler()
+    worker_log_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(worker_log_handler)
+    connection_main, connection_tc, connection_history, descendant_cache, result_cache = open_terminology_resources()
+    if incremental:
+        run_manifest = open_run_manifest()
+
+def process_report_task(report_xml):
+    """Process one serialized report element in a worker, returning its buffered log lines, any error, manifest updates and metrics."""
+    error = None
+    try:
+        process_report_element(XML_PARSER.fromstring(report_xml), database_path, transitive_closure_db_path, output_dir)
+    except Exception as e:
+        logger.exception(f"Failed to process report: {e}")
+        error = str(e)
+    manifest_updates = run_manifest.drain_updates() if run_manifest is not None else None
+    return worker_log_handler.drain(), error, manifest_updates, metrics.detach('reports')
+
+def report_codes_task(report_xml):
+    """Resolve one serialized report element in a worker and return its concept rows instead of writing outputs.
+
+    Returns (report name, sink rows, buffered log lines, error, metrics).
+    """
+    report = XML_PARSER.fromstring(report_xml)
+    file_name = report_file_name(report)
+    rows = []
+    error = None
+    try:
+        with metrics.scope('reports', report=file_name):
+            with metrics.stage('value_set_extraction'):
+                extracted_data = extract_values_single_pass(report)
+            for resolved in resolve_report_value_sets(extracted_data, connection_main, connection_tc, connection_history, descendant_cache, result_cache):
+                rows.extend(iter_concept_rows(file_name, resolved))
+    except Exception as e:
+        logger.exception(f"Failed to process report: {e}")
+        error = str(e)
+    return file_name, rows, worker_log_handler.drain(), error, metrics.detach('reports')
+
+def open_run_manifest():
+    terminology_paths = [snapshot_path] if snapshot_path else [database_path, transitive_closure_db_path, history_db_path]
+    return RunManifest(output_dir, terminology_fingerprint(*terminology_paths))
+
+def skip_unchanged_file(xml_file, xml_hash):
+    """Log and count an XML file that is unchanged since the last incremental run; return True if it can be skipped."""
+    if not run_manifest.file_unchanged(xml_file, xml_hash):
+        return False
+    report_count = len(run_manifest.files[xml_file]['reports'])
+    run_manifest.skipped_files += 1
+    run_manifest.reused_reports += report_count
+    logger.info(f"{xml_file} is unchanged since the last run. Keeping existing outputs for its {report_count} report{'s' if report_count != 1 else ''}.")
+    logger.info("-" * 40)
+    return True
+
+def run_parallel(xml_paths, workers, progress=None):
+    """Process the reports of all XML files across a pool of worker processes.
+
+    Log lines are replayed in submission order, so each report's output stays
+    together and in the same order as a serial run.
+    """
+    from concurrent.futures import Future, ProcessPoolExecutor
+
+    pending = deque()
+
+    def queue_log(message):
+        future = Future()
+        future.set_result(([(logging.INFO, message)], None, None, []))
+        pending.append((future, None, None))
+
+    def queue_progress(position, xml_file):
+        # Reported once the file's reports have been replayed
+        future = Future()
+        future.set_result(([], None, None, []))
+        pending.append((future, None, lambda: progress(position, len(xml_paths), xml_file)))
+
+    def emit_completed(max_pending):
+        while len(pending) > max_pending:
+            future, file_metrics, file_done = pending.popleft()
+            records, error, manifest_updates, report_metrics = future.result()
+            for levelno, message in records:
+                logger.log(levelno, message)
+            if manifest_updates is not None:
+                run_manifest.apply_updates(manifest_updates)
+            if file_metrics is not None:
+                file_metrics.setdefault('reports', []).extend(report_metrics)
+            if error:
+                raise RuntimeError(f"A worker failed to process a report: {error}")
+            if file_done is not None:
+                file_done()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(options,)) as executor:
+        for position, xml_path in enumerate(xml_paths, start=1):
+            xml_file = os.path.basename(xml_path)
+            if run_manifest is not None:
+                xml_hash = hash_file(xml_path, sorted(output_formats))
+                if skip_unchanged_file(xml_file, xml_hash):
+                    metrics.add_node('files', file=xml_file, skipped=True)
+                    if progress is not None:
+                        queue_progress(position, xml_file)
+                    continue
+            file_metrics = metrics.add_node('files', file=xml_file)
+            queue_log(f"Starting to process: {xml_file}")
+            if streaming:
+                reports = metrics.timed_iter(iter_report_elements(xml_path), 'xml_parse', file_metrics)
+            else:
+                with metrics.stage('xml_parse', file_metrics):
+                    reports = XML_PARSER.parse(xml_path).getroot().findall(".//ns:report", NAMESPACE)
+                queue_log(f"Found {len(reports)} reports:")
+                for report in reports:
+                    queue_log(report.find(".//ns:name", NAMESPACE).text)
+                queue_log("-" * 40)
+
+            report_names = []
+            for report in reports:
+                report_names.append(report_file_name(report))
+                pending.append((executor.submit(process_report_task, XML_PARSER.tostring(report)), file_metrics, None))
+                emit_completed(workers * 2)
+
+            if streaming:
+                queue_log(f"Processed {len(report_names)} report{'s' if len(report_names) != 1 else ''}.")
+                queue_log("-" * 40)
+            if run_manifest is not None:
+                run_manifest.record_file(xml_file, xml_hash, report_names)
+            if progress is not None:
+                queue_progress(position, xml_file)
+        emit_completed(0)
+
+def process_xml_file(xml_file):
+    """Process the reports of one file in xml_directory with the open terminology resources."""
+    xml_path = os.path.join(xml_directory, xml_file)
+    if run_manifest is not None:
+        xml_hash = hash_file(xml_path, sorted(output_formats))
+        if skip_unchanged_file(xml_file, xml_hash):
+            metrics.add_node('files', file=xml_file, skipped=True)
+            return
+    logger.info(f"Starting to process: {xml_file}")
+    with metrics.scope('files', file=xml_file):
+        if streaming:
+            report_names = extract_and_process_reports_from_xml_streaming(xml_path, database_path, transitive_closure_db_path, output_dir)
+        else:
+            report_names = extract_and_process_reports_from_xml(xml_path, database_path, transitive_closure_db_path, output_dir)
+    if run_manifest is not None:
+        run_manifest.record_file(xml_file, xml_hash, report_names)
+        run_manifest.save()
+    if descendant_cache is not None:
+        logger.info(descendant_cache.stats_message())
+
+def poll_directory(directory, work_queue, interval, stop_event):
+    """Queue each XML file in `directory` once it is new or modified and has stopped changing.
+
+    A file is settled when its size and modification time are the same on two scans
+    `interval` seconds apart. Scanning pauses while the queue is full, so files are
+    picked up no faster than they are processed.
+    """
+    queued = {}
+    changing = {}
+    while not stop_event.is_set():
+        try:
+            entries = sorted((entry.name, entry.stat()) for entry in os.scandir(directory) if entry.name.endswith('.xml') and entry.is_file())
+        except OSError as e:
+            logger.warning(f"Could not scan {directory}: {e}")
+            entries = []
+        for xml_file, stat in entries:
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if queued.get(xml_file) == signature or stat.st_size == 0:
+                continue
+            if changing.get(xml_file) != signature:
+                changing[xml_file] = signature
+                continue
+            del changing[xml_file]
+            while not stop_event.is_set():
+                try:
+                    work_queue.put(xml_file, timeout=interval)
+                    queued[xml_file] = signature
+                    break
+                except queue.Full:
+                    continue
+        stop_event.wait(interval)
+
+@one_run_at_a_time
+def watch_directory(run_options, resources=None):
+    """Process XML files as they are written to run_options.xml_directory until interrupted (Ctrl+C).
+
+    Terminology resources stay open between files; files already present when the
+    watch starts are processed first.
+    """
+    global connection_main, connection_tc, connection_history, descendant_cache, result_cache, run_manifest
+    configure(run_options)
+    if resources is None:
+        metrics.reset()
+    run_manifest = open_run_manifest() if incremental else None
+    os.makedirs(output_dir, exist_ok=True)
+    check_sink_dependencies(output_formats)
+    connection_main, connection_tc, connection_history, descendant_cache, result_cache = resources or open_terminology_resources()
+
+    work_queue = queue.Queue(maxsize=max(1, run_options.watch_queue))
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=poll_directory, args=(xml_directory, work_queue, run_options.watch_interval, stop_event), daemon=True)
+    watcher.start()
+    logger.info(f"Watching {xml_directory} for XML files. Press Ctrl+C to stop.")
+    try:
+        while True:
+            try:
+                xml_file = work_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                process_xml_file(xml_file)
+            except Exception as e:
+                # A file that cannot be processed is retried once it changes again
+                logger.exception(f"Failed to process {xml_file}: {e}")
+            file_nodes = metrics.root.get('files', [])
+            if file_nodes:
+                logger.info(dedup_message(file_nodes[-1]))
+            metrics.keep_last('files', WATCH_METRICS_FILES)
+            metrics.save(output_dir)
+            logger.info(f"Waiting for XML files ({work_queue.qsize()} queued).")
+    except KeyboardInterrupt:
+        logger.info("Stopped watching.")
+    finally:
+        stop_event.set()
+        if result_cache is not None:
+            logger.info(result_cache.stats_message())
+        if resources is None:
+            close_terminology_resources(connection_main, connection_tc, connection_history, result_cache)
+        if run_manifest is not None:
+            run_manifest.save()
+            logger.info(run_manifest.summary_message())
+        logger.info(f"Stage timings and query counts saved to {metrics.save(output_dir)}")
+
+@one_run_at_a_time
+def run_extraction(run_options, resources=None, progress=None):
+    """Run the extractor over every XML file in run_options.xml_directory and return a summary of the run.
+
+    `run_options` come from parse_args() or make_options(). Pass `resources` from
+    open_terminology_resources() to reuse warm connections and caches across runs;
+    they are left open for the caller. Otherwise they are opened and closed here.
+    `progress(completed_files, total_files, xml_file)` is called as each XML file is finished.
+    """
+    global connection_main, connection_tc, connection_history, descendant_cache, result_cache, run_manifest, metrics
+    start_time = time.time() #start clock
+    configure(run_options)
+    if resources is None:
+        metrics.reset()
+    run_manifest = None
+
+    # List XML files
+    xml_files = [f for f in os.listdir(xml_directory) if f.endswith('.xml')]
+    logger.info(f"Found {len(xml_files)} XML files in the directory: {xml_directory}")
+    for file in xml_files:
+        logger.info(f"{file}")
+    logger.info("-" * 40)
+
+    # Ensure output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+    check_sink_dependencies(output_formats)
+
+    if incremental:
+        run_manifest = open_run_manifest()
+
+    if workers > 1:
+        logger.info(f"Processing reports with {workers} worker processes.")
+        run_parallel([os.path.join(xml_directory, xml_file) for xml_file in xml_files], workers, progress)
+    else:
+        connection_main, connection_tc, connection_history, descendant_cache, result_cache = resources or open_terminology_resources()
+
+        # Extract and process reports from the XML
+        for position, xml_file in enumerate(xml_files, start=1):
+            process_xml_file(xml_file)
+            if progress is not None:
+                progress(position, len(xml_files), xml_file)
+
+        if result_cache is not None:
+            logger.info(result_cache.stats_message())
+        if resources is None:
+            close_terminology_resources(connection_main, connection_tc, connection_history, result_cache)
+
+    if run_manifest is not None:
+        run_manifest.save()
+        logger.info(run_manifest.summary_message())
+    logger.info(dedup_message(metrics.root))
     
     end_time = time.time()
     elapsed_time = end_time - start_time
+    metrics_path = metrics.save(output_dir)
+    logger.info(f"Stage timings and query counts saved to {metrics_path}")
     logger.info(f"Script executed in {elapsed_time:.2f} seconds.")
-    logger.info(f"Log has been saved to: {output_dir}")
\ No newline at end of file
+    report_count = sum(len(file_node.get('reports', [])) for file_node in metrics.root.get('files', []))
+    return {'xml_files': len(xml_files), 'reports': report_count, 'seconds': elapsed_time, 'metrics_path': metrics_path}
+
+class ExtractionPipeline:
+    """Run the extractor in-process, keeping terminology connections and caches open between runs.
+
+        pipeline = ExtractionPipeline(snapshot='terminology.snap')
+        pipeline.run(xml_directory, output_dir)
+        pipeline.close()
+
+    Settings use the command-line names and apply to every run; run() can override them.
+    Resources are reopened only when a terminology setting changes.
+
+    The extractor keeps the settings of the current run in module globals, so runs in
+    one process take turns: a run from another pipeline or thread waits until the
+    current one finishes. Use `workers`, extraction_service.py or http_service.py to
+    run extractions side by side.
+    """
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self.resources = None
+        self.resources_key = None
+
+    def run(self, xml_directory, output_dir, progress=None, **settings):
+        return self.run_options(make_options(xml_directory, output_dir, **{**self.settings, **settings}), progress)
+
+    @one_run_at_a_time
+    def run_options(self, run_options, progress=None):
+        """Run with options from parse_args() or make_options(); the pipeline's own settings are not applied."""
+        if run_options.workers > 1:
+            # Each worker process opens its own resources
+            return run_extraction(run_options, progress=progress)
+        configure(run_options)
+        metrics.reset()
+        resources_key = tuple(getattr(run_options, name) for name in TERMINOLOGY_OPTIONS)
+        if self.resources is None or resources_key != self.resources_key:
+            self.close()
+            self.resources = open_terminology_resources()
+            self.resources_key = resources_key
+        return run_extraction(run_options, self.resources, progress)
+
+    @one_run_at_a_time
+    def close(self):
+        if self.resources is not None:
+            close_terminology_resources(self.resources.connection_main, self.resources.connection_tc, self.resources.connection_history, self.resources.result_cache)
+            self.resources = None
+
+def main(argv=None):
+    run_options = parse_args(argv)
+    setup_logger(run_options.log_format, run_options.log_level)
+    if run_options.watch:
+        watch_directory(run_options)
+    else:
+        run_extraction(run_options)
+
+if __name__ == "__main__":
+    main()
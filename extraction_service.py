@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import itertools
+import threading
+import subprocess
+from log_events import JsonLinesHandler, relay_log_events
+
+logger = logging.getLogger("main_logger")
+
+SHUTDOWN = 'shutdown'
+
+def serve(input_stream=None, output_stream=None):
+    """Run extraction jobs read as JSON lines from `input_stream` (stdin) until it closes or a shutdown request arrives.
+
+    A job is {"job": id, "args": [extractor command-line arguments]}. Log records and
+    the events ready, job_started, progress, job_finished and job_failed are written
+    to `output_stream` (stdout) as JSON lines. Terminology connections and caches stay
+    open between jobs and are reopened only when a job names different terminology.
+    """
+    from emis_xml_snomed_extractor import ExtractionPipeline, parse_args
+    input_stream = input_stream if input_stream is not None else sys.stdin
+    handler = JsonLinesHandler(output_stream)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    for existing_handler in logger.handlers[:]:
+        logger.removeHandler(existing_handler)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    pipeline = ExtractionPipeline()
+    handler.send({'event': 'ready', 'pid': os.getpid()})
+    for line in iter(input_stream.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError:
+            logger.error(f"Ignoring a request that is not JSON: {line.strip()}")
+            continue
+        if request.get('command') == SHUTDOWN:
+            break
+
+        job = request.get('job')
+        handler.send({'event': 'job_started', 'job': job})
+
+        def progress(completed, total, xml_file):
+            handler.send({'event': 'progress', 'job': job, 'completed': completed, 'total': total, 'file': xml_file})
+
+        try:
+            run_options = parse_args(request.get('args', []))
+            logger.setLevel(run_options.log_level)
+            summary = pipeline.run_options(run_options, progress)
+        except SystemExit:
+            # argparse has already written the reason to stderr
+            handler.send({'event': 'job_failed', 'job': job, 'error': 'Invalid arguments'})
+        except Exception as e:
+            logger.exception(f"Script failed: {e}")
+            handler.send({'event': 'job_failed', 'job': job, 'error': str(e)})
+        else:
+            handler.send({'event': 'job_finished', 'job': job, 'summary': summary})
+
+    pipeline.close()
+    handler.close()
+
+class ServiceClient:
+    """Start the extraction service once and submit jobs to it.
+
+    Log records from the service are replayed into `logger`; other events are passed
+    to `on_event`. The service is started on the first submission and restarted if it
+    has exited, so its terminology connections and caches are reused across jobs.
+    """
+
+    def __init__(self, command, logger, on_event=None):
+        self.command = command
+        self.logger = logger
+        self.on_event = on_event
+        self.process = None
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        creation_flags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            creationflags=creation_flags
+        )
+        threading.Thread(target=relay_log_events, args=(self.process.stdout, self.logger, logging.INFO, self.on_event), daemon=True).start()
+        threading.Thread(target=relay_log_events, args=(self.process.stderr, self.logger, logging.ERROR), daemon=True).start()
+        self.logger.info("Extraction service started")
+
+    def submit(self, args):
+        """Queue a job with extractor command-line arguments and return its id."""
+        with self.lock:
+            if not self.running():
+                self.start()
+            job = next(self.job_ids)
+            self.process.stdin.write(json.dumps({'job': job, 'args': args}) + '\n')
+            self.process.stdin.flush()
+            return job
+
+    def close(self, timeout=10):
+        """Ask the service to exit once its queued jobs are done."""
+        with self.lock:
+            if not self.running():
+                return
+            try:
+                self.process.stdin.write(json.dumps({'command': SHUTDOWN}) + '\n')
+                self.process.stdin.close()
+                self.process.wait(timeout)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run extraction jobs read as JSON lines from stdin, keeping the terminology open between jobs')
+    parser.parse_args()
+    serve()
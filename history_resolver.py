@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import logging
+from result_cache import file_fingerprint
+
+logger = logging.getLogger("main_logger")
+
+HISTORY_MAP_FILE_NAME = 'history_map.json'
+HISTORY_MAP_VERSION = 2
+
+def strongly_connected_components(graph):
+    """Return the strongly connected components of `graph` ({node: [successors]}), successors first.
+
+    Iterative Tarjan's algorithm, so chains of any length can be walked without
+    recursion. Successors that are not keys of `graph` are left out.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    def visit(node):
+        index[node] = lowlink[node] = len(index)
+        stack.append(node)
+        on_stack.add(node)
+        return node, iter(graph[node])
+
+    for root in graph:
+        if root in index:
+            continue
+        work = [visit(root)]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in graph:
+                    continue
+                if successor not in index:
+                    work.append(visit(successor))
+                    break
+                if successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+def resolve_final_targets(pairs):
+    """Follow OLDCUI -> NEWCUI chains to their final concepts.
+
+    Returns ({old CUI: tuple of final CUIs}, cycle count). A concept replaced by several
+    concepts resolves to the final targets of each; one retired without a replacement
+    maps to an empty tuple. Chains are resolved once each, from their ends backwards.
+    Every concept in a cycle resolves to the same targets: the final targets of the
+    replacements that lead out of the cycle or, if none do, the concepts of the cycle.
+    """
+    replacements = {}
+    for old_cui, new_cui in pairs:
+        if old_cui is None:
+            continue
+        targets = replacements.setdefault(str(old_cui), [])
+        if new_cui is not None and str(new_cui) not in targets:
+            targets.append(str(new_cui))
+
+    order = {cui: position for position, cui in enumerate(replacements)}
+    final_targets = {}
+    cycles = 0
+    for component in strongly_connected_components(replacements):
+        component.sort(key=order.__getitem__)
+        members = set(component)
+        cyclic = len(component) > 1 or component[0] in replacements[component[0]]
+        targets = []
+        for cui in component:
+            for new_cui in replacements[cui]:
+                if new_cui in members:
+                    continue
+                # A retired concept with no replacement is the end of its chain
+                for target in final_targets.get(new_cui, (new_cui,)) or (new_cui,):
+                    if target not in targets:
+                        targets.append(target)
+        if cyclic:
+            cycles += 1
+            final_targets.update((cui, tuple(targets or component)) for cui in component)
+        else:
+            final_targets[component[0]] = tuple(targets)
+    return final_targets, cycles
+
+def cycle_message(cycles):
+    return f"Found {cycles} cycle{'s' if cycles != 1 else ''} in SCTHIST; their concepts resolve to the concepts each cycle leads to, or to the cycle's own concepts."
+
+class HistoryMap:
+    """SCTHIST resolved once into a map from each old CUI to its final replacement CUIs.
+
+    Can be passed wherever a history connection is expected.
+    """
+
+    def __init__(self, final_targets):
+        self.final_targets = final_targets
+
+    @classmethod
+    def from_connection(cls, connection):
+        start_time = time.time()
+        cursor = connection.cursor()
+        cursor.execute("SELECT OLDCUI, NEWCUI FROM SCTHIST")
+        final_targets, cycles = resolve_final_targets((row.OLDCUI, row.NEWCUI) for row in cursor.fetchall())
+        if cycles:
+            logger.info(cycle_message(cycles))
+        logger.info(f"Resolved history chains for {len(final_targets)} concepts in {time.time() - start_time:.2f} seconds.")
+        return cls(final_targets)
+
+    @classmethod
+    def open_for(cls, cache_dir, history_db_path, connection):
+        """Load the map precomputed for this history database from `cache_dir`, or build and save it."""
+        path = os.path.join(cache_dir, HISTORY_MAP_FILE_NAME)
+        fingerprint = file_fingerprint(history_db_path)
+        try:
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get('version') == HISTORY_MAP_VERSION and saved.get('fingerprint') == fingerprint:
+                return cls({old_cui: tuple(targets) for old_cui, targets in saved['final_targets'].items()})
+        except (OSError, ValueError, KeyError):
+            pass
+
+        history_map = cls.from_connection(connection)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Worker processes may build the map at the same time, so each writes its own temporary file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': HISTORY_MAP_VERSION, 'fingerprint': fingerprint, 'final_targets': history_map.final_targets}, f)
+        os.replace(temp_path, path)
+        return history_map
+
+    def new_cuis_for(self, old_cuis):
+        """Return {old CUI: tuple of final CUIs} for the CUIs that appear in SCTHIST."""
+        return {old_cui: self.final_targets[old_cui] for old_cui in dict.fromkeys(old_cuis) if old_cui in self.final_targets}
+
+    def close(self):
+        pass
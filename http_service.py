@@ -0,0 +1,296 @@
+import io
+import csv
+import json
+import time
+import signal
+import logging
+import argparse
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import emis_xml_snomed_extractor as extractor
+from output_sinks import SINK_COLUMNS
+from pipeline_metrics import stage_totals
+
+logger = logging.getLogger("main_logger")
+
+# Extractor options that describe the terminology shared by every job
+TERMINOLOGY_ARGUMENTS = ['database_path', 'transitive_closure_db_path', 'history_db_path', 'snapshot', 'backend', 'closure_engine', 'descendant_cache_mb', 'cache_dir', 'no_result_cache']
+
+class BatchJob:
+    """The reports of one submission, resolved across the worker pool.
+
+    Report results are kept in submission order; `iter_rows` yields them as soon as
+    each report in turn is finished, so results can be streamed while the job runs.
+    """
+
+    def __init__(self, job_id, report_names, futures):
+        self.job_id = job_id
+        self.report_names = report_names
+        self.results = [None] * len(futures)
+        self.errors = []
+        self.report_metrics = []
+        self.reports_done = 0
+        self.submitted = time.time()
+        self.finished = self.submitted if not futures else None
+        self.condition = threading.Condition()
+        for position, future in enumerate(futures):
+            future.add_done_callback(lambda future, position=position: self.report_done(position, future))
+
+    def report_done(self, position, future):
+        try:
+            report_name, rows, records, error, report_metrics = future.result()
+        except Exception as e:
+            # The worker process itself failed
+            rows, records, error, report_metrics = [], [], str(e), []
+        for levelno, message in records:
+            logger.log(levelno, message)
+        with self.condition:
+            self.results[position] = rows
+            if error:
+                self.errors.append({'report': self.report_names[position], 'error': error})
+            self.report_metrics.extend(report_metrics)
+            self.reports_done += 1
+            if self.reports_done == len(self.results):
+                self.finished = time.time()
+            self.condition.notify_all()
+
+    def done(self):
+        return self.finished is not None
+
+    def status(self):
+        with self.condition:
+            if not self.done():
+                status = 'running' if self.reports_done else 'queued'
+            else:
+                status = 'failed' if self.errors else 'done'
+            return {
+                'job': self.job_id,
+                'status': status,
+                'reports': len(self.results),
+                'reports_done': self.reports_done,
+                'errors': list(self.errors),
+                'seconds': (self.finished or time.time()) - self.submitted,
+                'stage_totals': stage_totals({'stages': {}, 'reports': list(self.report_metrics)}),
+            }
+
+    def iter_rows(self):
+        """Yield the sink rows of each report in order, waiting for reports that are still running."""
+        for position in range(len(self.results)):
+            with self.condition:
+                while self.results[position] is None:
+                    self.condition.wait()
+                rows = self.results[position]
+            yield from rows
+
+    def report_results(self):
+        """Return the finished job's code lists grouped by report and value set."""
+        reports = OrderedDict((name, OrderedDict()) for name in self.report_names)
+        for report_name, value_set, code, term, source_value, provenance in self.iter_rows():
+            codes = reports.setdefault(report_name, OrderedDict()).setdefault(value_set, [])
+            codes.append({'code': code, 'term': term, 'source_value': source_value, 'provenance': provenance})
+        return [{'report': report_name, 'value_sets': [{'value_set': value_set, 'codes': codes} for value_set, codes in value_sets.items()]}
+                for report_name, value_sets in reports.items()]
+
+def init_service_worker(run_options):
+    # Workers are forked after the server maps SIGTERM to KeyboardInterrupt; let the pool terminate them quietly
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    extractor.init_worker(run_options)
+
+class BatchService:
+    """Queue EMIS XML payloads and resolve their reports on a pool of warm worker processes.
+
+    Each worker opens the terminology once, when it starts, and keeps its connections
+    and descendant cache for every job it serves; the persistent result cache and a
+    memory-mapped snapshot are shared between workers through the file system.
+    """
+
+    def __init__(self, run_options, workers=2, keep_jobs=100):
+        self.run_options = run_options
+        self.workers = workers
+        self.keep_jobs = keep_jobs
+        self.jobs = OrderedDict()
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.executor = self.start_executor()
+
+    def start_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=init_service_worker, initargs=(self.run_options,))
+
+    def submit_reports(self, reports):
+        """Queue one task per report, starting a new worker pool if a worker process has died.
+
+        Raises BrokenProcessPool if the new pool is broken too.
+        """
+        with self.lock:
+            executor = self.executor
+        try:
+            return [executor.submit(extractor.report_codes_task, extractor.XML_PARSER.tostring(report)) for report in reports]
+        except BrokenProcessPool:
+            with self.lock:
+                if self.executor is executor:
+                    logger.warning("A worker process exited unexpectedly. Starting a new worker pool.")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = self.start_executor()
+                executor = self.executor
+            return [executor.submit(extractor.report_codes_task, extractor.XML_PARSER.tostring(report)) for report in reports]
+
+    def submit(self, payloads):
+        """Queue the reports of one or more XML payloads as a job and return it. Raises ValueError for XML that does not parse."""
+        reports = []
+        for payload in payloads:
+            try:
+                root = extractor.XML_PARSER.fromstring(payload.encode('utf-8') if isinstance(payload, str) else payload)
+            except Exception as e:
+                raise ValueError(f"Invalid XML payload: {e}")
+            reports.extend(root.findall(".//ns:report", extractor.NAMESPACE))
+
+        report_names = [extractor.report_file_name(report) for report in reports]
+        futures = self.submit_reports(reports)
+        with self.lock:
+            job = BatchJob(next(self.job_ids), report_names, futures)
+            self.jobs[job.job_id] = job
+            # Forget the oldest finished jobs beyond the retention limit
+            for job_id in [job_id for job_id, old_job in self.jobs.items() if old_job.done()][:max(0, len(self.jobs) - self.keep_jobs)]:
+                del self.jobs[job_id]
+        logger.info(f"Queued job {job.job_id} with {len(reports)} report{'s' if len(reports) != 1 else ''}.")
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return {'status': 'ok', 'workers': self.workers, 'jobs': len(jobs), 'running_jobs': sum(1 for job in jobs if not job.done())}
+
+    def close(self):
+        with self.lock:
+            executor = self.executor
+        executor.shutdown(cancel_futures=True)
+
+def read_payloads(body, content_type):
+    """Return the XML payloads of a request: a raw XML body, or JSON {"payloads": [xml, ...]}."""
+    if 'json' not in content_type:
+        return [body]
+    try:
+        payloads = json.loads(body)['payloads']
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('Expected a JSON object with a "payloads" list of XML strings')
+    if not isinstance(payloads, list) or not all(isinstance(payload, str) for payload in payloads):
+        raise ValueError('Expected a JSON object with a "payloads" list of XML strings')
+    return payloads
+
+class BatchRequestHandler(BaseHTTPRequestHandler):
+    """POST /jobs, GET /jobs/<id>, GET /jobs/<id>/results[?format=csv] and GET /health."""
+
+    service = None
+
+    def send_json(self, status, content):
+        body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {'error': message})
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            return self.send_error_json(404, 'Not found')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            job = self.service.submit(read_payloads(body, self.headers.get('Content-Type', '')))
+        except ValueError as e:
+            return self.send_error_json(400, str(e))
+        except BrokenProcessPool as e:
+            logger.error(f"Could not queue a job: {e}")
+            return self.send_error_json(503, 'The worker processes are not available; try again later')
+        self.send_json(202, job.status())
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if parts == ['health']:
+            return self.send_json(200, self.service.status())
+        if len(parts) not in (2, 3) or parts[0] != 'jobs' or not parts[1].isdigit() or parts[2:] not in ([], ['results']):
+            return self.send_error_json(404, 'Not found')
+        job = self.service.get(int(parts[1]))
+        if job is None:
+            return self.send_error_json(404, f"No job {parts[1]}")
+        if len(parts) == 2:
+            return self.send_json(200, job.status())
+
+        if parse_qs(url.query).get('format', ['json'])[0] == 'csv':
+            return self.stream_csv(job)
+        # JSON results are returned once the whole job has finished
+        self.send_json(200, dict(job.status(), results=job.report_results()))
+
+    def stream_csv(self, job):
+        """Stream the job's rows as CSV, report by report, while the job runs."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(SINK_COLUMNS)
+        for row in job.iter_rows():
+            writer.writerow(row)
+            if buffer.tell() > 65536:
+                self.wfile.write(buffer.getvalue().encode('utf-8'))
+                buffer.seek(0)
+                buffer.truncate()
+        self.wfile.write(buffer.getvalue().encode('utf-8'))
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local HTTP service that resolves EMIS XML payloads to SNOMED code lists')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes; each keeps its own terminology connections open')
+    parser.add_argument('--keep_jobs', type=int, default=100, help='Finished jobs kept for status and result requests')
+    parser.add_argument('--log_level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING'])
+    parser.add_argument('--database_path')
+    parser.add_argument('--transitive_closure_db_path')
+    parser.add_argument('--history_db_path')
+    parser.add_argument('--snapshot', default=None, help='Compiled terminology snapshot to use instead of the three databases')
+    parser.add_argument('--backend', default='auto', choices=['auto'] + list(extractor.BACKENDS))
+    parser.add_argument('--closure_engine', default='database', choices=['database', 'memory'])
+    parser.add_argument('--descendant_cache_mb', type=float, default=256)
+    parser.add_argument('--cache_dir', default=None)
+    parser.add_argument('--no_result_cache', action='store_true')
+    args = parser.parse_args(argv)
+
+    try:
+        run_options = extractor.make_options('', '', **{name: getattr(args, name) for name in TERMINOLOGY_ARGUMENTS})
+    except ValueError as e:
+        parser.error(str(e))
+    extractor.setup_logger('text', args.log_level)
+
+    BatchRequestHandler.service = BatchService(run_options, args.workers, args.keep_jobs)
+    server = ThreadingHTTPServer((args.host, args.port), BatchRequestHandler)
+    server.daemon_threads = True
+    # Stop cleanly on SIGTERM too, so the worker processes are shut down with the server
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger.info(f"Serving on http://{args.host}:{server.server_address[1]} with {args.workers} worker{'s' if args.workers != 1 else ''}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        BatchRequestHandler.service.close()
+
+if __name__ == "__main__":
+    main()
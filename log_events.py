@@ -0,0 +1,94 @@
+import sys
+import json
+import logging
+import threading
+
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 0.1
+
+class JsonLinesHandler(logging.Handler):
+    """Write log records to a stream as JSON lines ({"level", "levelno", "time", "message"}), in batches.
+
+    Records are buffered and written with a single write once `batch_size` have
+    accumulated or `flush_interval` seconds after the first buffered record, so a
+    reader receives a few large chunks instead of one pipe write per line.
+    """
+
+    def __init__(self, stream=None, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL):
+        logging.Handler.__init__(self)
+        self.stream = stream if stream is not None else sys.stdout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.timer = None
+
+    def emit(self, record):
+        try:
+            self.buffer.append(json.dumps({'level': record.levelname, 'levelno': record.levelno, 'time': record.created, 'message': self.format(record)}))
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = threading.Timer(self.flush_interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.buffer:
+                batch, self.buffer = self.buffer, []
+                self.stream.write('\n'.join(batch) + '\n')
+                self.stream.flush()
+        finally:
+            self.release()
+
+    def send(self, event):
+        """Write a non-log event (a dict with an "event" key) after the records buffered so far."""
+        self.acquire()
+        try:
+            self.buffer.append(json.dumps(event))
+            self.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
+
+def load_event(line):
+    """Return the JSON object on a line, or None if the line is not one."""
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    return event if isinstance(event, dict) else None
+
+def parse_log_event(line, default_level=logging.INFO):
+    """Return (levelno, message) for a JSON-lines log event; other lines are returned as-is at `default_level`."""
+    line = line.rstrip('\r\n')
+    event = load_event(line)
+    try:
+        return int(event['levelno']), str(event['message'])
+    except (KeyError, TypeError, ValueError):
+        return default_level, line.strip()
+
+def relay_log_events(pipe, logger, default_level=logging.INFO, on_event=None):
+    """Replay log events read from a subprocess pipe into `logger` until the pipe closes.
+
+    Other events (JSON objects with an "event" key) are passed to `on_event`.
+    """
+    for line in iter(pipe.readline, ''):
+        event = load_event(line)
+        if event is not None and 'event' in event:
+            if on_event is not None:
+                on_event(event)
+            continue
+        levelno, message = parse_log_event(line, default_level)
+        logger.log(levelno, message)
+    pipe.close()
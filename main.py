@@ -10,6 +10,8 @@ import webbrowser
 import logging
 import shutil
 from collections import deque
+from log_events import relay_log_events
+from extraction_service import ServiceClient
 
 # Initialize directory
 config_file_path, script_path, xml_directory, database_path, transitive_closure_db_path, history_db_path, output_dir = initialize_directory_structure()
@@ -28,15 +30,16 @@ class TextHandler(logging.Handler):
         self._schedule_update()
 
     def _schedule_update(self):
-        self.text_widget.after(10, self._update_display)
+        self.text_widget.after(100, self._update_display)
 
     def _update_display(self):
-        self.text_widget.config(state=tk.NORMAL)
-        while self.log_cache:
-            log_entry = self.log_cache.popleft()
-            self.text_widget.insert(ctk.END, log_entry + '\n')
+        # Insert everything logged since the last update in one widget update
+        if self.log_cache:
+            log_entries = [self.log_cache.popleft() for _ in range(len(self.log_cache))]
+            self.text_widget.config(state=tk.NORMAL)
+            self.text_widget.insert(ctk.END, '\n'.join(log_entries) + '\n')
             self.text_widget.see(ctk.END)
-        self.text_widget.config(state=tk.DISABLED)
+            self.text_widget.config(state=tk.DISABLED)
         self._schedule_update()
 
     def emit(self, record):
@@ -195,7 +198,7 @@ def main():
             source_dir = output_dir
 
             # Build the full command with arguments
-            full_command = [python_interpreter, script_path, '--source_dir', source_dir, '--output_dir', output_dir]
+            full_command = [python_interpreter, script_path, '--source_dir', source_dir, '--output_dir', output_dir, '--incremental']
 
             creation_flags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
             process = subprocess.Popen(
@@ -208,14 +211,9 @@ def main():
             )
             logger.info("Consolidate Workbooks subprocess started")
 
-            def stream_output(pipe, log_func):
-                for line in iter(pipe.readline, ''):
-                    log_func(line.strip())
-                pipe.close()
-
             # Start threads for stdout and stderr
-            stdout_thread = threading.Thread(target=stream_output, args=(process.stdout, logger.info))
-            stderr_thread = threading.Thread(target=stream_output, args=(process.stderr, logger.error))
+            stdout_thread = threading.Thread(target=relay_log_events, args=(process.stdout, logger, logging.INFO))
+            stderr_thread = threading.Thread(target=relay_log_events, args=(process.stderr, logger, logging.ERROR))
             stdout_thread.start()
             stderr_thread.start()
 
@@ -253,7 +251,7 @@ def main():
         base_path = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
         return os.path.join(base_path, relative_path)
 
-    def execute_subprocess(args):
+    def service_command():
         # Attempt to find an external Python interpreter in the system's PATH
         python_interpreter = shutil.which('python')
 
@@ -264,44 +262,25 @@ def main():
             logger.warning("No Python interpreter found. Please ensure Python is installed and set in the PATH.")
 
         # Construct the script path using get_resource_path
-        script_path = get_resource_path('emis_xml_snomed_extractor.py')
-
-        # Build the full command
-        full_command = [python_interpreter, script_path] + args
-
-        creation_flags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
-        process = subprocess.Popen(
-            full_command, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE, 
-            text=True, 
-            universal_newlines=True,
-            creationflags=creation_flags
-        )
-        logger.info("Subprocess started")
-
-        def read_from_pipe(pipe, log_func):
-            for line in iter(pipe.readline, ''):
-                log_func(line.strip())
-            pipe.close()
-
-        # Start threads for stdout and stderr
-        stdout_thread = threading.Thread(target=read_from_pipe, args=(process.stdout, logger.info))
-        stderr_thread = threading.Thread(target=read_from_pipe, args=(process.stderr, logger.error))
-        stdout_thread.start()
-        stderr_thread.start()
-        stdout_thread.join()
-        stderr_thread.join()
-
-        process.wait()
+        return [python_interpreter, get_resource_path('extraction_service.py')]
+
+    def on_service_event(event):
+        if event['event'] == 'progress':
+            logger.info(f"Processed {event['completed']}/{event['total']} XML files.")
+        elif event['event'] == 'job_failed':
+            logger.error(f"Script failed: {event['error']}")
+        if event['event'] in ('job_finished', 'job_failed'):
+            # Check for log file after the script completes
+            update_open_log_button_visibility()
 
-        if process.returncode != 0:
-            logger.error(f"Script failed with error code {process.returncode}.")
+    # One extraction service per session: runs after the first reuse its open terminology and warm caches
+    service = ServiceClient(service_command(), logger, on_service_event)
 
-        # Check for log file after the script completes
-        update_open_log_button_visibility()
+    def close_window():
+        service.close()
+        root.destroy()
 
-        return process.returncode
+    root.protocol("WM_DELETE_WINDOW", close_window)
 
     def run_script(entries=None):
         if entries:
@@ -320,8 +299,7 @@ def main():
             "--output_dir", paths[4]
         ]
 
-        thread = threading.Thread(target=execute_subprocess, args=(args,))
-        thread.start()
+        service.submit(args)
 
     root.mainloop()
 
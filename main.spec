@@ -6,7 +6,7 @@ a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[('config.ini', '.'), ('emis_xml_snomed_extractor.py', '.'), ('directory_functions.py', '.'), ('consolidate_workbooks.py', '.')], 
+    datas=[('config.ini', '.'), ('emis_xml_snomed_extractor.py', '.'), ('directory_functions.py', '.'), ('consolidate_workbooks.py', '.'), ('terminology_backends.py', '.'), ('closure_engine.py', '.'), ('descendant_cache.py', '.'), ('result_cache.py', '.'), ('output_sinks.py', '.'), ('run_manifest.py', '.'), ('terminology_snapshot.py', '.'), ('history_resolver.py', '.'), ('pipeline_metrics.py', '.'), ('log_events.py', '.'), ('extraction_service.py', '.'), ('value_set_store.py', '.')], 
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
@@ -0,0 +1,103 @@
+import os
+import csv
+import json
+
+# Columns written by every sink, one row per concept in a value set
+SINK_COLUMNS = ['report', 'value_set', 'code', 'term', 'source_value', 'provenance']
+
+class CsvSink:
+    extension = '.csv'
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(SINK_COLUMNS)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+class JsonlSink:
+    extension = '.jsonl'
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write_rows(self, rows):
+        self.file.writelines(json.dumps(dict(zip(SINK_COLUMNS, row)), ensure_ascii=False) + '\n' for row in rows)
+
+    def close(self):
+        self.file.close()
+
+class ParquetSink:
+    """Write rows as Parquet row groups, one per write_rows call (requires pyarrow)."""
+    extension = '.parquet'
+
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.path = path
+        self.pa = pa
+        self.schema = pa.schema([
+            ('report', pa.string()),
+            ('value_set', pa.int32()),
+            ('code', pa.string()),
+            ('term', pa.string()),
+            ('source_value', pa.string()),
+            ('provenance', pa.string()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write_rows(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        arrays = [self.pa.array([None if value is None else (int(value) if name == 'value_set' else str(value)) for value in column], type=self.schema.field(name).type)
+                  for name, column in zip(SINK_COLUMNS, columns)]
+        self.writer.write_batch(self.pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+SINKS = {
+    'csv': CsvSink,
+    'jsonl': JsonlSink,
+    'parquet': ParquetSink,
+}
+
+def check_sink_dependencies(output_formats):
+    """Fail early if a requested output format needs a package that is not installed."""
+    if 'parquet' in output_formats:
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise ImportError("Parquet output requires the 'pyarrow' package. Install it with: pip install pyarrow")
+
+def create_sink(output_format, output_dir, report_name):
+    sink_class = SINKS[output_format]
+    return sink_class(os.path.join(output_dir, f"snomed_codes_{report_name}{sink_class.extension}"))
+
+def read_sink_rows(path):
+    """Yield each row of a CSV, JSON Lines or Parquet sink file as a dict keyed by SINK_COLUMNS."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                row['value_set'] = int(row['value_set'])
+                yield row
+    elif extension == '.jsonl':
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+    else:
+        raise ValueError(f"Unsupported output file: {path}")
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+
+METRICS_FILE_NAME = 'metrics.json'
+
+class CountingCursor:
+    """Cursor wrapper that counts SQL round trips and fetched rows."""
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args):
+        self.counter['round_trips'] += 1
+        self.cursor.execute(*args)
+        return self
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.counter['rows'] += len(rows)
+        return rows
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self.counter['rows'] += len(rows)
+        return rows
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.counter['rows'] += 1
+        return row
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.counter['rows'] += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class CountingConnection:
+    def __init__(self, connection, counter):
+        self.connection = connection
+        self.counter = counter
+
+    def cursor(self):
+        return CountingCursor(self.connection.cursor(), self.counter)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+def add_stage(node, name, seconds, queries):
+    stage = node['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0, 'queries': {}})
+    stage['seconds'] += seconds
+    stage['calls'] += 1
+    for connection_name, (round_trips, rows) in queries.items():
+        counts = stage['queries'].setdefault(connection_name, {'round_trips': 0, 'rows': 0})
+        counts['round_trips'] += round_trips
+        counts['rows'] += rows
+
+def merge_stages(totals, stages):
+    for name, stage in stages.items():
+        total = totals.setdefault(name, {'seconds': 0.0, 'calls': 0, 'queries': {}})
+        total['seconds'] += stage['seconds']
+        total['calls'] += stage['calls']
+        for connection_name, counts in stage['queries'].items():
+            total_counts = total['queries'].setdefault(connection_name, {'round_trips': 0, 'rows': 0})
+            total_counts['round_trips'] += counts['round_trips']
+            total_counts['rows'] += counts['rows']
+
+def stage_totals(node):
+    """Sum the stages of a node and every node below it."""
+    totals = {}
+    merge_stages(totals, node['stages'])
+    for kind in ('files', 'reports', 'value_sets'):
+        for child in node.get(kind, []):
+            merge_stages(totals, stage_totals(child))
+    return totals
+
+def fill_seconds(node):
+    """Give nodes that were never timed as a whole (value sets, files processed by workers) the sum of their parts."""
+    children = [child for kind in ('files', 'reports', 'value_sets') for child in node.get(kind, [])]
+    for child in children:
+        fill_seconds(child)
+    if node['seconds'] is None:
+        node['seconds'] = sum(stage['seconds'] for stage in node['stages'].values()) + sum(child['seconds'] for child in children)
+
+class PipelineMetrics:
+    """Wall time, SQL round trips and rows fetched for each pipeline stage.
+
+    Stages are recorded on the innermost open scope (run, file, report) or on an
+    explicit node such as a value set, and saved as a tree to metrics.json.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.reset()
+
+    def reset(self):
+        """Start a new run. Counters are zeroed in place, so connections wrapped earlier keep counting."""
+        self.start_time = time.perf_counter()
+        for counter in self.counters.values():
+            counter['round_trips'] = counter['rows'] = 0
+        self.root = {'stages': {}}
+        self.stack = [self.root]
+
+    def count_queries(self, connection, name):
+        """Wrap a DB-API connection so its queries are counted under `name`; other objects are returned unchanged."""
+        if not hasattr(connection, 'cursor'):
+            return connection
+        return CountingConnection(connection, self.counters.setdefault(name, {'round_trips': 0, 'rows': 0}))
+
+    def query_counts(self):
+        return {name: (counter['round_trips'], counter['rows']) for name, counter in self.counters.items()}
+
+    def query_delta(self, before):
+        delta = {}
+        for name, (round_trips, rows) in self.query_counts().items():
+            previous_round_trips, previous_rows = before.get(name, (0, 0))
+            if round_trips != previous_round_trips or rows != previous_rows:
+                delta[name] = (round_trips - previous_round_trips, rows - previous_rows)
+        return delta
+
+    @contextmanager
+    def stage(self, name, node=None):
+        node = node if node is not None else self.stack[-1]
+        before = self.query_counts()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            add_stage(node, name, time.perf_counter() - start_time, self.query_delta(before))
+
+    def timed_iter(self, iterable, name, node=None):
+        """Yield from `iterable`, timing the work of producing each item as a stage (e.g. incremental parsing)."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name, node):
+                item = next(iterator, None)
+            if item is None:
+                return
+            yield item
+
+    def add_node(self, kind, **info):
+        """Add a child node (file, report or value set) under the current scope without opening it."""
+        node = dict(info, seconds=None, stages={})
+        self.stack[-1].setdefault(kind, []).append(node)
+        return node
+
+    @contextmanager
+    def scope(self, kind, **info):
+        node = self.add_node(kind, **info)
+        self.stack.append(node)
+        start_time = time.perf_counter()
+        try:
+            yield node
+        finally:
+            node['seconds'] = time.perf_counter() - start_time
+            self.stack.pop()
+
+    def value_set(self, index, **info):
+        """Return the node for value set `index` of the current report, creating it if needed."""
+        for node in self.stack[-1].get('value_sets', []):
+            if node['index'] == index:
+                node.update(info)
+                return node
+        return self.add_node('value_sets', index=index, **info)
+
+    def detach(self, kind):
+        """Remove and return the nodes of one kind from the current scope (used to send worker results to the parent)."""
+        return self.stack[-1].pop(kind, [])
+
+    def keep_last(self, kind, count):
+        """Drop all but the last `count` nodes of one kind from the run, so a long-running process does not grow without limit."""
+        nodes = self.root.get(kind, [])
+        if len(nodes) > count:
+            del nodes[:len(nodes) - count]
+
+    def save(self, output_dir):
+        for file_node in self.root.get('files', []):
+            fill_seconds(file_node)
+            file_node['stage_totals'] = stage_totals(file_node)
+        metrics = {
+            'total_seconds': time.perf_counter() - self.start_time,
+            'stage_totals': stage_totals(self.root),
+            'connections': self.counters,
+            'startup': self.root['stages'],
+            'files': self.root.get('files', []),
+        }
+        path = os.path.join(output_dir, METRICS_FILE_NAME)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(metrics, f, indent=1)
+        return path
@@ -0,0 +1,102 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+
+logger = logging.getLogger("main_logger")
+
+CACHE_FILE_NAME = 'terminology_cache.sqlite'
+# Raised when the meaning of cached lookups changes, e.g. display names matching regardless of case
+CACHE_VERSION = 2
+FINGERPRINT_SAMPLE_BYTES = 1024 * 1024
+
+# Namespaces stored in the cache
+TUI_TO_CUI = 'tui_to_cui'
+TERM_TO_CUI = 'term_to_cui'
+CUI_TO_TERM = 'cui_to_term'
+DESCENDANTS = 'descendants'
+
+# Marker for keys that were looked up and are not in the terminology
+NOT_FOUND = object()
+
+def file_fingerprint(path):
+    """Fingerprint a file from its size, mtime and a hash of its first and last megabyte."""
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_SAMPLE_BYTES))
+        if stat.st_size > FINGERPRINT_SAMPLE_BYTES:
+            f.seek(max(FINGERPRINT_SAMPLE_BYTES, stat.st_size - FINGERPRINT_SAMPLE_BYTES))
+            digest.update(f.read(FINGERPRINT_SAMPLE_BYTES))
+    return f"{stat.st_size}:{int(stat.st_mtime)}:{digest.hexdigest()}"
+
+def terminology_fingerprint(*paths):
+    """Fingerprint the configured SCT, SCTTC and SCTHIST databases (or snapshot) so a new release invalidates cached results."""
+    parts = [file_fingerprint(path) for path in paths]
+    return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """Persistent SQLite cache of terminology lookups, valid for a single terminology fingerprint.
+
+    Each namespace maps a key to a JSON value. Keys looked up and not found are
+    stored too, so later runs do not query them again; they come back as NOT_FOUND.
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # An in-process pipeline may be driven from several threads, one run at a time
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (namespace TEXT, key TEXT, value TEXT, PRIMARY KEY (namespace, key)) WITHOUT ROWID")
+
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            if row is not None:
+                logger.info("Terminology databases have changed since the result cache was built. Clearing cached results.")
+            self.connection.execute("DELETE FROM entries")
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fingerprint', ?)", (fingerprint,))
+        else:
+            entry_count = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            logger.info(f"Using result cache {path} with {entry_count} cached lookups.")
+        self.connection.commit()
+
+    @classmethod
+    def open_for(cls, cache_dir, database_path, transitive_closure_db_path, history_db_path):
+        fingerprint = f"{CACHE_VERSION}:{terminology_fingerprint(database_path, transitive_closure_db_path, history_db_path)}"
+        return cls(os.path.join(cache_dir, CACHE_FILE_NAME), fingerprint)
+
+    def get_many(self, namespace, keys):
+        """Return {key: value} for the cached keys; uncached keys are left out."""
+        keys = list(dict.fromkeys(keys))
+        key_lookup = {str(key): key for key in keys}
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = [str(key) for key in keys[start:start + 500]]
+            query = "SELECT key, value FROM entries WHERE namespace = ? AND key IN ({})".format(','.join(['?'] * len(chunk)))
+            for key, value in self.connection.execute(query, [namespace] + chunk):
+                found[key_lookup[key]] = NOT_FOUND if value is None else json.loads(value)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, namespace, mapping, missing=()):
+        """Store looked-up values, and mark `missing` keys as not found."""
+        rows = [(namespace, str(key), json.dumps(value)) for key, value in mapping.items()]
+        rows.extend((namespace, str(key), None) for key in missing if key not in mapping)
+        if rows:
+            self.connection.executemany("INSERT OR REPLACE INTO entries (namespace, key, value) VALUES (?, ?, ?)", rows)
+            self.connection.commit()
+
+    def stats_message(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0
+        return f"Result cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)."
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger("main_logger")
+
+MANIFEST_FILE_NAME = 'extraction_manifest.json'
+MANIFEST_VERSION = 3
+
+def hash_value_sets(data, *extra):
+    """Hash the extracted value sets of a report, plus any settings that change its outputs."""
+    normalized = [[[value, display_name, include_children, sorted(exceptions, key=str)] for value, display_name, include_children, exceptions in value_set]
+                  for value_set in data]
+    payload = json.dumps([normalized, list(extra)], default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def hash_file(path, *extra):
+    """Hash the bytes of an XML file, plus any settings that change its outputs."""
+    digest = hashlib.sha256(json.dumps(list(extra), default=str).encode('utf-8'))
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class RunManifest:
+    """Record of the inputs behind each report's outputs, used to skip unchanged work on the next run.
+
+    Entries from a run made against a different terminology fingerprint are ignored.
+    """
+
+    def __init__(self, output_dir, terminology_fingerprint):
+        self.path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+        self.output_dir = output_dir
+        self.terminology_fingerprint = terminology_fingerprint
+        self.reports = {}
+        self.files = {}
+        self.reused_reports = 0
+        self.processed_reports = 0
+        self.skipped_files = 0
+        self.pending_updates = {}
+
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get('version') != MANIFEST_VERSION:
+            return
+        if manifest.get('terminology') != terminology_fingerprint:
+            logger.info("Terminology databases have changed since the last run. All reports will be processed.")
+            return
+        self.reports = manifest.get('reports', {})
+        self.files = manifest.get('files', {})
+
+    def outputs_exist(self, report_name):
+        entry = self.reports.get(report_name)
+        return entry is not None and all(os.path.exists(os.path.join(self.output_dir, output)) for output in entry['outputs'])
+
+    def report_unchanged(self, report_name, content_hash):
+        entry = self.reports.get(report_name)
+        return entry is not None and entry['hash'] == content_hash and self.outputs_exist(report_name)
+
+    def record_report(self, report_name, content_hash, output_paths):
+        entry = {'hash': content_hash, 'outputs': [os.path.basename(path) for path in output_paths]}
+        self.reports[report_name] = entry
+        self.pending_updates[report_name] = entry
+
+    def drain_updates(self):
+        """Return and reset the report entries and counts recorded since the last drain (used by worker processes)."""
+        updates = (self.pending_updates, self.reused_reports, self.processed_reports)
+        self.pending_updates, self.reused_reports, self.processed_reports = {}, 0, 0
+        return updates
+
+    def apply_updates(self, updates):
+        report_entries, reused_reports, processed_reports = updates
+        self.reports.update(report_entries)
+        self.reused_reports += reused_reports
+        self.processed_reports += processed_reports
+
+    def file_unchanged(self, xml_file, file_hash):
+        """True if the XML file is byte-identical to the last run and every report from it still has its outputs."""
+        entry = self.files.get(xml_file)
+        return entry is not None and entry['hash'] == file_hash and all(self.outputs_exist(report_name) for report_name in entry['reports'])
+
+    def record_file(self, xml_file, file_hash, report_names):
+        self.files[xml_file] = {'hash': file_hash, 'reports': list(report_names)}
+
+    def save(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'terminology': self.terminology_fingerprint,
+                       'reports': self.reports, 'files': self.files}, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+    def summary_message(self):
+        total = self.reused_reports + self.processed_reports
+        return (f"Incremental run: reused existing outputs for {self.reused_reports} of {total} report{'s' if total != 1 else ''} "
+                f"({self.skipped_files} unchanged XML file{'s' if self.skipped_files != 1 else ''} skipped).")
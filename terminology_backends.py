@@ -0,0 +1,195 @@
+import os
+import csv
+import sqlite3
+import logging
+import argparse
+from collections import namedtuple
+from pathlib import Path
+
+logger = logging.getLogger("main_logger")
+
+# Tables and columns the extractor reads from the DMWB databases
+TERMINOLOGY_TABLES = {
+    'SCT': ('TUI', 'CUI', 'Term'),
+    'SCTTC': ('SupertypeID', 'SubtypeID'),
+    'SCTHIST': ('OLDCUI', 'NEWCUI'),
+}
+TERMINOLOGY_INDEXES = [
+    ('idx_sct_tui', 'SCT', 'TUI'),
+    ('idx_sct_term', 'SCT', 'Term'),
+    ('idx_sct_cui', 'SCT', 'CUI'),
+    ('idx_scttc_supertype', 'SCTTC', 'SupertypeID'),
+    ('idx_scthist_oldcui', 'SCTHIST', 'OLDCUI'),
+]
+# Display names match regardless of case, as they do in the Access databases
+NOCASE_COLUMNS = {('SCT', 'Term')}
+IMPORT_BATCH_SIZE = 10000
+
+def term_key(term):
+    """Case-insensitive key for matching a display name to SCT.Term."""
+    return (term or '').lower()
+
+def connect_access(path):
+    """Open a DMWB Access database through the Microsoft Access ODBC driver (Windows only)."""
+    import pyodbc
+    connection_str = (
+        r'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};'
+        f'DBQ={path};'
+    )
+    return pyodbc.connect(connection_str)
+
+_row_classes = {}
+
+def namedtuple_row_factory(cursor, row):
+    """Return rows with attribute access (row.CUI) so SQLite rows behave like pyodbc rows."""
+    fields = tuple(column[0] for column in cursor.description)
+    row_class = _row_classes.get(fields)
+    if row_class is None:
+        row_class = _row_classes[fields] = namedtuple('Row', fields)
+    return row_class(*row)
+
+def connect_sqlite(path):
+    """Open a terminology database built by `import` read-only."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"SQLite terminology database not found: {path}")
+    # An in-process pipeline may be driven from several threads, one run at a time
+    connection = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+    connection.row_factory = namedtuple_row_factory
+    return connection
+
+# Backend name -> (connect function, file extensions handled when backend is 'auto')
+BACKENDS = {
+    'access': (connect_access, ('.mdb', '.accdb')),
+    'sqlite': (connect_sqlite, ('.sqlite', '.sqlite3', '.db')),
+}
+
+def register_backend(name, connect, extensions=()):
+    """Register a terminology backend. `connect(path)` must return a DB-API connection whose rows support attribute access."""
+    BACKENDS[name] = (connect, tuple(ext.lower() for ext in extensions))
+
+def backend_for_path(path):
+    extension = os.path.splitext(path)[1].lower()
+    for name, (_, extensions) in BACKENDS.items():
+        if extension in extensions:
+            return name
+    raise ValueError(f"Cannot determine terminology backend for '{path}'. Use one of: {', '.join(BACKENDS)}")
+
+def connect_terminology(path, backend='auto'):
+    """Open a connection to a terminology database using the named backend, or by file extension when 'auto'."""
+    if backend == 'auto':
+        backend = backend_for_path(path)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown terminology backend '{backend}'. Use one of: {', '.join(BACKENDS)}")
+    connect, _ = BACKENDS[backend]
+    return connect(path)
+
+def read_access_table(path, table):
+    """Yield (column, ...) tuples for one DMWB table from an Access database."""
+    return read_database_table(connect_access(path), table)
+
+def read_database_table(connection, table):
+    """Yield (column, ...) tuples for one DMWB table from an open connection, closing it when done."""
+    columns = TERMINOLOGY_TABLES[table]
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT {', '.join(columns)} FROM {table}")
+        while True:
+            rows = cursor.fetchmany(IMPORT_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(None if value is None else str(value) for value in row)
+    finally:
+        connection.close()
+
+def read_flat_table(path, table):
+    """Yield (column, ...) tuples for one DMWB table from a delimited export with a header row."""
+    columns = TERMINOLOGY_TABLES[table]
+    delimiter = ',' if path.lower().endswith('.csv') else '\t'
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = [name.strip().lower() for name in next(reader)]
+        try:
+            positions = [header.index(column.lower()) for column in columns]
+        except ValueError:
+            raise ValueError(f"{path} must have columns {', '.join(columns)} for table {table}; found {', '.join(header)}")
+        for row in reader:
+            if row:
+                yield tuple(row[position] or None for position in positions)
+
+def read_source_table(path, table):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in BACKENDS['access'][1]:
+        return read_access_table(path, table)
+    if extension in BACKENDS['sqlite'][1]:
+        return read_database_table(connect_sqlite(path), table)
+    return read_flat_table(path, table)
+
+def build_sqlite_database(output_path, sct_path, tc_path, history_path):
+    """Build an indexed SQLite terminology database from DMWB Access databases or flat exports."""
+    sources = {'SCT': sct_path, 'SCTTC': tc_path, 'SCTHIST': history_path}
+    temp_path = output_path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    connection = sqlite3.connect(temp_path)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        for table, source_path in sources.items():
+            columns = TERMINOLOGY_TABLES[table]
+            column_types = [f"{column} TEXT COLLATE NOCASE" if (table, column) in NOCASE_COLUMNS else f"{column} TEXT" for column in columns]
+            connection.execute(f"CREATE TABLE {table} ({', '.join(column_types)})")
+            insert = f"INSERT INTO {table} VALUES ({', '.join(['?'] * len(columns))})"
+            logger.info(f"Importing {table} from {source_path}")
+            row_count = 0
+            batch = []
+            for row in read_source_table(source_path, table):
+                batch.append(row)
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    connection.executemany(insert, batch)
+                    row_count += len(batch)
+                    batch = []
+            connection.executemany(insert, batch)
+            row_count += len(batch)
+            logger.info(f"Imported {row_count} rows into {table}")
+
+        for index_name, table, column in TERMINOLOGY_INDEXES:
+            logger.info(f"Creating index {index_name}")
+            connection.execute(f"CREATE INDEX {index_name} ON {table} ({column})")
+        connection.execute("ANALYZE")
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(temp_path, output_path)
+    logger.info(f"SQLite terminology database saved to {output_path}")
+    return output_path
+
+def main():
+    parser = argparse.ArgumentParser(description='Terminology database tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help='Build an indexed SQLite terminology database')
+    import_parser.add_argument('--output', required=True, help='Path of the .sqlite file to create')
+    import_parser.add_argument('--sct', required=True, help='DMWB NHS SNOMED.mdb or a delimited export of SCT (TUI, CUI, Term)')
+    import_parser.add_argument('--transitive_closure', required=True, help='DMWB NHS SNOMED Transitive Closure.mdb or a delimited export of SCTTC (SupertypeID, SubtypeID)')
+    import_parser.add_argument('--history', required=True, help='DMWB NHS SNOMED History.mdb or a delimited export of SCTHIST (OLDCUI, NEWCUI)')
+
+    snapshot_parser = subparsers.add_parser('compile-snapshot', help='Compile a memory-mapped terminology snapshot for --snapshot (requires numpy)')
+    snapshot_parser.add_argument('--output', required=True, help='Path of the snapshot file to create')
+    snapshot_parser.add_argument('--sct', required=True, help='SCT source: Access database, SQLite database from import, or delimited export')
+    snapshot_parser.add_argument('--transitive_closure', required=True, help='SCTTC source: Access database, SQLite database from import, or delimited export')
+    snapshot_parser.add_argument('--history', required=True, help='SCTHIST source: Access database, SQLite database from import, or delimited export')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.command == 'import':
+        build_sqlite_database(args.output, args.sct, args.transitive_closure, args.history)
+    elif args.command == 'compile-snapshot':
+        from terminology_snapshot import compile_snapshot
+        compile_snapshot(args.output, args.sct, args.transitive_closure, args.history)
+
+if __name__ == '__main__':
+    main()
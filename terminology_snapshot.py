@@ -0,0 +1,218 @@
+import os
+import mmap
+import json
+import time
+import struct
+import bisect
+import logging
+import numpy as np
+from closure_engine import ClosureIndex, to_int_ids
+from terminology_backends import read_source_table, term_key
+from history_resolver import resolve_final_targets, cycle_message
+
+logger = logging.getLogger("main_logger")
+
+SNAPSHOT_MAGIC = b'SCTSNAP\0'
+SNAPSHOT_VERSION = 4
+# Magic, format version and header length, followed by the JSON header and the aligned arrays
+PREAMBLE = struct.Struct('<8sII')
+ALIGNMENT = 64
+
+def last_by_key(keys, values):
+    """Sort parallel arrays by key, keeping the value of the last occurrence of each key (as a dict update would)."""
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    keep = np.ones(len(keys), dtype=bool)
+    keep[:-1] = keys[1:] != keys[:-1]
+    return keys[keep], values[keep]
+
+class StringHeap:
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def add(self, value):
+        position = self.index.get(value)
+        if position is None:
+            position = self.index[value] = len(self.strings)
+            self.strings.append(value)
+        return position
+
+    def arrays(self):
+        encoded = [value.encode('utf-8') for value in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+def compile_snapshot(output_path, sct_path, tc_path, history_path):
+    """Compile SCT, SCTTC and SCTHIST into one memory-mappable snapshot file.
+
+    Where a key occurs more than once the last row wins, matching the lookups the
+    extractor makes against the databases. Non-numeric IDs are left out.
+    """
+    start_time = time.time()
+    heap = StringHeap()
+    tuis, cuis, term_ids = [], [], []
+    logger.info(f"Reading SCT from {sct_path}")
+    for tui, cui, term in read_source_table(sct_path, 'SCT'):
+        tuis.append(tui)
+        cuis.append(cui)
+        term_ids.append(heap.add(term or ''))
+    tui_ids, tui_valid = to_int_ids(tuis)
+    cui_ids, cui_valid = to_int_ids(cuis)
+    term_ids = np.array(term_ids, dtype=np.int64)
+    del tuis, cuis
+
+    valid = tui_valid & cui_valid
+    tui_keys, tui_cuis = last_by_key(tui_ids[valid], cui_ids[valid])
+    cui_keys, cui_terms = last_by_key(cui_ids[cui_valid], term_ids[cui_valid])
+    # Terms are ordered by their case-folded UTF-8 bytes so display names can be found by binary search, ignoring case
+    term_keys, term_cuis = last_by_key(term_ids[cui_valid], cui_ids[cui_valid])
+    string_offsets, string_heap = heap.arrays()
+    term_bytes = [term_key(heap.strings[term_id]).encode('utf-8') for term_id in term_keys.tolist()]
+    order = sorted(range(len(term_keys)), key=term_bytes.__getitem__)
+    term_keys, term_cuis = term_keys[order], term_cuis[order]
+    del heap, term_bytes
+
+    logger.info(f"Reading SCTTC from {tc_path}")
+    pairs = [(supertype, subtype) for supertype, subtype in read_source_table(tc_path, 'SCTTC')]
+    supertypes, supertype_valid = to_int_ids([pair[0] for pair in pairs])
+    subtypes, subtype_valid = to_int_ids([pair[1] for pair in pairs])
+    del pairs
+    closure = ClosureIndex.from_pairs(supertypes[supertype_valid & subtype_valid], subtypes[supertype_valid & subtype_valid])
+
+    logger.info(f"Reading SCTHIST from {history_path}")
+    final_targets, cycles = resolve_final_targets(read_source_table(history_path, 'SCTHIST'))
+    if cycles:
+        logger.info(cycle_message(cycles))
+    # Final replacement CUIs of history_old[i] are history_targets[history_offsets[i]:history_offsets[i + 1]]
+    old_ids, old_valid = to_int_ids(list(final_targets))
+    order = np.argsort(old_ids, kind='stable')
+    target_lists = list(final_targets.values())
+    history_old = old_ids[order][old_valid[order]]
+    kept_targets = [to_int_ids(target_lists[position])[0] for position in order.tolist() if old_valid[position]]
+    history_offsets = np.zeros(len(kept_targets) + 1, dtype=np.int64)
+    np.cumsum([len(targets) for targets in kept_targets], out=history_offsets[1:])
+    history_targets = np.concatenate(kept_targets) if kept_targets else np.zeros(0, dtype=np.int64)
+    del final_targets, target_lists, kept_targets
+
+    arrays = {
+        'tui_keys': tui_keys, 'tui_cuis': tui_cuis,
+        'cui_keys': cui_keys, 'cui_terms': cui_terms,
+        'term_keys': term_keys, 'term_cuis': term_cuis,
+        'string_offsets': string_offsets, 'string_heap': string_heap,
+        'closure_concepts': closure.concept_ids, 'closure_offsets': closure.offsets, 'closure_descendants': closure.descendants,
+        'history_old': history_old, 'history_offsets': history_offsets, 'history_targets': history_targets,
+    }
+    write_snapshot(output_path, arrays, {'sources': [os.path.basename(path) for path in (sct_path, tc_path, history_path)],
+                                         'created': time.strftime('%Y-%m-%d %H:%M:%S')})
+    logger.info(f"Terminology snapshot saved to {output_path}: {len(tui_keys)} descriptions, {len(cui_keys)} concepts, "
+                f"{len(closure.descendants)} closure relationships, {len(history_old)} history rows "
+                f"in {time.time() - start_time:.2f} seconds.")
+    return output_path
+
+def write_snapshot(output_path, arrays, metadata):
+    directory = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        directory[name] = {'dtype': array.dtype.str, 'offset': offset, 'length': len(array)}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps(dict(metadata, arrays=directory)).encode('utf-8')
+    data_start = -(-(PREAMBLE.size + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    temp_path = output_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + directory[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(temp_path, output_path)
+
+class TerminologySnapshot:
+    """A compiled terminology snapshot opened with mmap.
+
+    The arrays are zero-copy NumPy views over the mapped file, so opening is fast and
+    worker processes share the pages through the OS cache. One instance can be passed
+    as the main, transitive closure and history connection.
+    """
+
+    def __init__(self, path):
+        start_time = time.time()
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length = PREAMBLE.unpack_from(self.mmap, 0)
+        if magic != SNAPSHOT_MAGIC:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a terminology snapshot")
+        if version != SNAPSHOT_VERSION:
+            self.mmap.close()
+            raise ValueError(f"{path} is snapshot version {version}; this version of the extractor reads version {SNAPSHOT_VERSION}. Compile it again.")
+        self.metadata = json.loads(self.mmap[PREAMBLE.size:PREAMBLE.size + header_length])
+        data_start = -(-(PREAMBLE.size + header_length) // ALIGNMENT) * ALIGNMENT
+        for name, entry in self.metadata['arrays'].items():
+            setattr(self, name, np.frombuffer(self.mmap, dtype=np.dtype(entry['dtype']), count=entry['length'], offset=data_start + entry['offset']))
+        self.closure = ClosureIndex(self.closure_concepts, self.closure_offsets, self.closure_descendants)
+        logger.info(f"Opened terminology snapshot {path} ({len(self.tui_keys)} descriptions, {len(self.cui_keys)} concepts) "
+                    f"in {(time.time() - start_time) * 1000:.1f} ms.")
+
+    def string(self, position):
+        return bytes(self.string_heap[self.string_offsets[position]:self.string_offsets[position + 1]]).decode('utf-8')
+
+    def _folded_term(self, term_id):
+        return term_key(self.string(term_id)).encode('utf-8')
+
+    @staticmethod
+    def _search(keys, values, lookup_keys):
+        """Return {key: value} for the lookup keys present in the sorted `keys` array, in key order like an index scan."""
+        lookup_keys = list(dict.fromkeys(lookup_keys))
+        ids, valid = to_int_ids(lookup_keys)
+        positions = np.minimum(np.searchsorted(keys, ids), max(len(keys) - 1, 0))
+        found = valid & (keys[positions] == ids) if len(keys) else np.zeros(len(ids), dtype=bool)
+        return {key: values[position] for position, key in sorted((position, key) for key, position, hit in zip(lookup_keys, positions.tolist(), found.tolist()) if hit)}
+
+    def cuis_for_tuis(self, tuis):
+        return {tui: str(cui) for tui, cui in self._search(self.tui_keys, self.tui_cuis, tuis).items()}
+
+    def terms_for_cuis(self, cuis):
+        return {cui: self.string(term_id) for cui, term_id in self._search(self.cui_keys, self.cui_terms, cuis).items()}
+
+    def cuis_for_terms(self, terms):
+        found = {}
+        for term in dict.fromkeys(terms):
+            if term is None:
+                continue
+            target = term_key(term).encode('utf-8')
+            position = bisect.bisect_left(self.term_keys, target, key=self._folded_term)
+            if position < len(self.term_keys) and self._folded_term(self.term_keys[position]) == target:
+                found[term] = str(self.term_cuis[position])
+        return found
+
+    def new_cuis_for(self, old_cuis):
+        """Return {old CUI: tuple of final CUIs} for the CUIs that appear in SCTHIST."""
+        positions = self._search(self.history_old, np.arange(len(self.history_old)), old_cuis)
+        return {old_cui: tuple(map(str, self.history_targets[self.history_offsets[position]:self.history_offsets[position + 1]].tolist()))
+                for old_cui, position in positions.items()}
+
+    def descendant_array(self, code):
+        return self.closure.descendant_array(code)
+
+    def descendant_ids(self, code):
+        return self.closure.descendant_ids(code)
+
+    def close(self):
+        if self.mmap is None:
+            return
+        mapped, self.mmap = self.mmap, None
+        for name in self.metadata['arrays']:
+            delattr(self, name)
+        self.closure = None
+        try:
+            mapped.close()
+        except BufferError:
+            # A caller still holds a view into the file; the mapping is released with it
+            pass
@@ -0,0 +1,44 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_resolver import resolve_final_targets
+
+class ResolveFinalTargetsTests(unittest.TestCase):
+
+    def test_chain_resolves_to_final_concept(self):
+        final_targets, cycles = resolve_final_targets([('1', '2'), ('2', '3')])
+        self.assertEqual(final_targets, {'1': ('3',), '2': ('3',)})
+        self.assertEqual(cycles, 0)
+
+    def test_split_and_retired_concepts(self):
+        final_targets, _ = resolve_final_targets([('1', '2'), ('1', '3'), ('3', None), ('4', None)])
+        self.assertEqual(final_targets['1'], ('2', '3'))
+        self.assertEqual(final_targets['3'], ())
+        self.assertEqual(final_targets['4'], ())
+
+    def test_two_node_cycle_resolves_the_same_in_any_order(self):
+        for pairs in ([('A', 'B'), ('B', 'A')], [('B', 'A'), ('A', 'B')]):
+            final_targets, cycles = resolve_final_targets(pairs)
+            self.assertEqual(cycles, 1)
+            self.assertEqual(final_targets['A'], final_targets['B'])
+            self.assertEqual(set(final_targets['A']), {'A', 'B'})
+
+    def test_cycle_with_an_exit_resolves_to_the_exit(self):
+        for pairs in ([('A', 'B'), ('B', 'A'), ('B', 'C'), ('C', 'D')], [('C', 'D'), ('B', 'C'), ('B', 'A'), ('A', 'B')]):
+            final_targets, cycles = resolve_final_targets(pairs)
+            self.assertEqual(cycles, 1)
+            self.assertEqual(final_targets['A'], ('D',))
+            self.assertEqual(final_targets['B'], ('D',))
+
+    def test_deep_chain_does_not_recurse(self):
+        depth = sys.getrecursionlimit() * 5
+        final_targets, cycles = resolve_final_targets((str(position), str(position + 1)) for position in range(depth))
+        self.assertEqual(cycles, 0)
+        self.assertEqual(final_targets['0'], (str(depth),))
+        self.assertEqual(final_targets[str(depth - 1)], (str(depth),))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from run_manifest import hash_value_sets
+
+def value_set_key(value_set_data):
+    """Content address of a value set: a hash of its (value, displayName, includeChildren, exceptions) rows."""
+    return hash_value_sets([value_set_data])
+
+class ValueSetStore:
+    """Run-wide store of resolved value sets keyed by their content address.
+
+    Identical value sets in different reports and files are resolved once and the
+    stored result is reused for every sheet that contains them. Entries are evicted
+    least recently used first beyond `max_entries`.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the stored resolved value set for `key`, or None."""
+        resolved = self._entries.get(key)
+        if resolved is not None:
+            self._entries.move_to_end(key)
+        return resolved
+
+    def put(self, key, resolved):
+        self._entries[key] = resolved
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+def count_value_sets(node):
+    """Return (value sets, value sets reused from the store) below a metrics node."""
+    total = reused = 0
+    for value_set in node.get('value_sets', []):
+        total += 1
+        reused += bool(value_set.get('deduplicated'))
+    for kind in ('files', 'reports'):
+        for child in node.get(kind, []):
+            child_total, child_reused = count_value_sets(child)
+            total += child_total
+            reused += child_reused
+    return total, reused
+
+def dedup_message(node):
+    total, reused = count_value_sets(node)
+    ratio = (reused / total * 100) if total else 0
+    return f"Value sets: {total} in reports, {total - reused} resolved, {reused} reused from identical value sets ({ratio:.1f}% deduplicated)."